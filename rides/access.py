@@ -0,0 +1,127 @@
+"""
+Cached access decisions for the ride WebSocket consumers.
+
+Connect-time checks ("may this user stream this ride's location / chat with
+this partner?") are cached per (ride, user[, partner]). Every entry of a ride
+is keyed under that ride's access version, so bumping the version when a ride
+or one of its requests changes status invalidates them all at once. The bump
+is also broadcast to the ride's ``ride_access_<id>`` group so connected
+sockets re-check and close if they lost access.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_PASSENGER_STATUSES = ["CONFIRMED", "IN_VEHICLE"]
+
+DENIED = {"has_access": False, "is_driver": False}
+
+
+def access_group_name(ride_id):
+    return f"ride_access_{ride_id}"
+
+
+def _version_key(ride_id):
+    return f"rides:access:version:{ride_id}"
+
+
+def _cached(key, ride_id, decide):
+    version = cache.get(_version_key(ride_id), 0)
+    decision = cache.get(key, version=version)
+    if decision is None:
+        decision = decide()
+        cache.set(key, decision, timeout=settings.RIDE_ACCESS_CACHE_TTL, version=version)
+    return decision
+
+
+def _ride_driver_id(ride_id):
+    from rides.models import RideDetails
+
+    return RideDetails.objects.filter(id=ride_id).values_list("driver_id", flat=True).first()
+
+
+def _is_active_passenger(ride_id, user_id):
+    from rides.models import PassengerRideRequest
+
+    return PassengerRideRequest.objects.filter(
+        ride_id=ride_id, passenger_id=user_id, status__in=ACTIVE_PASSENGER_STATUSES
+    ).exists()
+
+
+def _user_email(user_id):
+    from authentication.models import User
+
+    return User.objects.filter(id=user_id).values_list("email", flat=True).first()
+
+
+def get_location_access(ride_id, user_id):
+    """The driver or a confirmed/in-vehicle passenger may stream locations."""
+
+    def decide():
+        driver_id = _ride_driver_id(ride_id)
+        if driver_id is None:
+            return DENIED
+        if driver_id == user_id:
+            return {"has_access": True, "is_driver": True}
+        if _is_active_passenger(ride_id, user_id):
+            return {"has_access": True, "is_driver": False}
+        return DENIED
+
+    return _cached(f"rides:access:location:{ride_id}:{user_id}", ride_id, decide)
+
+
+def get_chat_access(ride_id, user_id, partner_id):
+    """
+    Chats are between the driver and one confirmed/in-vehicle passenger.
+    A granted decision also carries the partner's email for the consumer's
+    participant cache.
+    """
+
+    def decide():
+        driver_id = _ride_driver_id(ride_id)
+        if driver_id is None:
+            return DENIED
+        if driver_id == user_id and _is_active_passenger(ride_id, partner_id):
+            is_driver = True
+        elif driver_id == partner_id and _is_active_passenger(ride_id, user_id):
+            is_driver = False
+        else:
+            return DENIED
+        return {
+            "has_access": True,
+            "is_driver": is_driver,
+            "partner_email": _user_email(partner_id),
+        }
+
+    return _cached(
+        f"rides:access:chat:{ride_id}:{user_id}:{partner_id}", ride_id, decide
+    )
+
+
+def invalidate(ride_id):
+    """Drop the ride's cached decisions and make connected sockets re-check."""
+    cache.add(_version_key(ride_id), 0, timeout=None)
+    try:
+        cache.incr(_version_key(ride_id))
+    except ValueError:
+        pass
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            access_group_name(ride_id), {"type": "access_changed", "ride_id": ride_id}
+        )
+    except Exception:
+        logger.exception("Could not broadcast access change for ride %s", ride_id)
+
+
+def schedule_invalidate(ride_id):
+    transaction.on_commit(lambda: invalidate(ride_id))
@@ -0,0 +1,113 @@
+"""
+Channel layer that spreads rides across several Redis instances.
+
+RedisChannelLayer already accepts several hosts, but it places every group
+by a CRC of the full group name modulo the number of hosts: the groups of
+one ride land on different shards, and adding a host moves almost every
+group. ShardedRedisChannelLayer places groups by the ride id in their name
+(ride_location_12_driver, ride_access_12, chat_ride_12_user_3_7 all go to
+the same shard) on a consistent-hash ring, so adding a shard moves only
+about 1/N of the rides. Process channels are placed on the same ring by
+their name.
+
+Group membership lives on the shard a ride hashes to, so after the host
+list changes, sockets of moved rides have to reconnect to rejoin.
+"""
+import bisect
+import hashlib
+import re
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels_redis.core import RedisChannelLayer
+
+from rides import metrics
+
+RIDE_GROUP_PATTERN = re.compile(r"(?:^|_)ride_(?:[a-z]+_)?(\d+)")
+
+
+def host_label(host):
+    """host:port of a channels_redis host entry, without credentials."""
+    if "address" in host:
+        url = urlsplit(host["address"])
+        return f"{url.hostname}:{url.port or 6379}"
+    return f"{host.get('host')}:{host.get('port')}"
+
+
+def placement_key(value):
+    """The ride a group belongs to, or the name itself for anything else."""
+    match = RIDE_GROUP_PATTERN.search(value)
+    return f"ride:{match.group(1)}" if match else value
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with `replicas` virtual nodes per shard."""
+
+    def __init__(self, shard_count, replicas=160):
+        points = sorted(
+            (_hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shard_count)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._shards[index % len(self._shards)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing(self.ring_size, replicas)
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        return self.ring.shard_for(placement_key(value))
+
+    async def group_send(self, group, message):
+        shard = self.consistent_hash(group)
+        started = time.perf_counter()
+        try:
+            await super().group_send(group, message)
+        except Exception:
+            metrics.incr(f"channel_layer_shard_{shard}_errors")
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.incr(f"channel_layer_shard_{shard}_group_sends")
+        metrics.incr(f"channel_layer_shard_{shard}_group_send_ms", elapsed_ms)
+        metrics.peak(f"channel_layer_shard_{shard}_group_send_ms", elapsed_ms)
+
+    async def shard_health(self):
+        """PING every shard; one entry per host with its round trip or error."""
+        shards = []
+        for index, host in enumerate(self.hosts):
+            entry = {"shard": index, "host": host_label(host)}
+            started = time.perf_counter()
+            try:
+                await self.connection(index).ping()
+            except Exception as error:
+                entry.update(healthy=False, error=str(error))
+            else:
+                entry.update(
+                    healthy=True,
+                    latency_ms=round((time.perf_counter() - started) * 1000, 3),
+                )
+            shards.append(entry)
+        return shards
+
+
+def shard_health():
+    """Health of the configured layer's shards, or None if it isn't sharded."""
+    layer = get_channel_layer()
+    if not isinstance(layer, ShardedRedisChannelLayer):
+        return None
+    return async_to_sync(layer.shard_health)()
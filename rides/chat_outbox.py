@@ -0,0 +1,160 @@
+"""
+Write-behind persistence of chat messages.
+
+RideChatConsumer gives every message its message_id and timestamp, broadcasts
+it right away and appends it to the process-wide ChatOutbox. The outbox
+writes ChatMessage rows with one bulk_create when RIDE_CHAT_FLUSH_SIZE
+messages are waiting or RIDE_CHAT_FLUSH_INTERVAL seconds after the first
+one, whichever comes first.
+
+Delivery to the database is at-least-once: a failed batch is put back and
+retried, and whatever is queued is flushed when the process exits. Sockets
+leaving don't force a flush (a reconnect storm would become a flush storm).
+(message_id, sender) is unique, so a batch written twice is stored once.
+While the database is down at most RIDE_CHAT_MAX_QUEUED messages are kept:
+beyond that the oldest are dropped and counted in the
+chat_messages_dropped metric.
+
+A client re-sending a message after a reconnect reuses its message_id. The
+consumer claims every client-supplied id with claim_message_id first and
+drops the frame if that sender already used it within RIDE_CHAT_DEDUP_TTL,
+so the partner does not see it twice either.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from rides import metrics, ws_cache
+
+logger = logging.getLogger(__name__)
+
+
+def message_id_key(sender_id, message_id):
+    return f"rides:chat:message_id:{sender_id}:{message_id}"
+
+
+async def claim_message_id(sender_id, message_id):
+    """True the first time `sender_id` sends `message_id`, False for a re-send."""
+    return await ws_cache.aadd(
+        message_id_key(sender_id, message_id),
+        True,
+        timeout=settings.RIDE_CHAT_DEDUP_TTL,
+    )
+
+
+class ChatOutbox:
+    def __init__(self, flush_size=None, flush_interval=None, max_queued=None):
+        self.flush_size = (
+            settings.RIDE_CHAT_FLUSH_SIZE if flush_size is None else flush_size
+        )
+        self.flush_interval = (
+            settings.RIDE_CHAT_FLUSH_INTERVAL
+            if flush_interval is None
+            else flush_interval
+        )
+        self.max_queued = (
+            settings.RIDE_CHAT_MAX_QUEUED if max_queued is None else max_queued
+        )
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def append(self, **fields):
+        """Queue one ChatMessage (as model field values) for the next batch."""
+        with self._lock:
+            self._pending.append(fields)
+            size = len(self._pending)
+        metrics.peak("chat_outbox_depth", size)
+
+        if size >= self.flush_size:
+            self.flush_soon()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self.flush_soon)
+
+    def flush_soon(self):
+        """Start a background flush unless one is already running."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(
+                sync_to_async(self.flush, thread_sensitive=False)()
+            )
+            self._flush_task.add_done_callback(self._retry_later)
+        return self._flush_task
+
+    def _retry_later(self, task):
+        # Messages put back by a failed flush, or queued while it ran
+        if self._pending and self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self.flush_soon)
+
+    def queued_timestamp(self, message_id, ride_id, user_ids):
+        """Timestamp of a message of this conversation still waiting here, or None."""
+        with self._lock:
+            for fields in reversed(self._pending):
+                if (
+                    fields["message_id"] == message_id
+                    and fields["ride_id"] == ride_id
+                    and {fields["sender_id"], fields["receiver_id"]} == user_ids
+                ):
+                    return fields["timestamp"]
+        return None
+
+    def _requeue(self, pending):
+        with self._lock:
+            self._pending[:0] = pending
+            # Messages are queued in send order, so the oldest are a prefix
+            overflow = len(self._pending) - self.max_queued
+            if overflow <= 0:
+                return
+            del self._pending[:overflow]
+        metrics.incr("chat_messages_dropped", overflow)
+        logger.warning("Chat outbox full, dropped the %s oldest messages", overflow)
+
+    def flush(self):
+        """Write everything queued in one bulk insert; puts it back on failure."""
+        from rides.models import ChatMessage
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+
+        close_old_connections()
+        try:
+            ChatMessage.objects.bulk_create(
+                [ChatMessage(**fields) for fields in pending],
+                batch_size=self.flush_size,
+                ignore_conflicts=True,
+            )
+        except Exception:
+            logger.exception("Chat flush failed, keeping %s messages queued", len(pending))
+            metrics.incr("chat_outbox_failures")
+            self._requeue(pending)
+            return 0
+        finally:
+            close_old_connections()
+        metrics.incr("chat_outbox_written", len(pending))
+        return len(pending)
+
+
+_outbox = None
+
+
+def get_chat_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = ChatOutbox()
+        atexit.register(_outbox.flush)
+    return _outbox
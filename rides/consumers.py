@@ -1,126 +1,393 @@
 import json
-import re
-from datetime import datetime
+import logging
+import time
+import uuid
 
-from channels.auth import AuthMiddlewareStack
-from channels.db import database_sync_to_async
-from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.contrib.auth import get_user_model
-from django.contrib.auth.models import User
-from django.contrib.gis.geos import Point
 from django.utils import timezone
 
-from rides import consumers
-from rides.models import ChatMessage, PassengerRideRequest, RideDetails
+from rides import access, location_codec, snapshots, trails
+from rides.chat_outbox import claim_message_id, get_chat_outbox
+from rides.db_executor import db_sync_to_async
+from rides.middleware import AUTH_SUBPROTOCOL
+from rides.outbound import OutboundQueue
+from rides.location import (LocationThrottle, driver_group_name, last_positions,
+                            parse_position, passengers_group_name,
+                            remember_position)
+
+logger = logging.getLogger(__name__)
+
+
+def chat_group_name(ride_id, user_id, partner_id):
+    # One group per driver-passenger pair
+    return f"chat_ride_{ride_id}_user_{min(user_id, partner_id)}_{max(user_id, partner_id)}"
+
+
+class RideSocketMixin:
+    """
+    What every ride socket shares: the bounded outbound queue, the optional
+    binary location subprotocol and the ride's access group. The location and
+    chat streams below are layered on top of it, either one per socket (the
+    original routes) or several on one multiplexed socket.
+    """
+
+    # Multiplexed sockets tag every frame with its type; the original routes don't
+    typed_frames = False
+
+    def send_frame(self, frame_type, payload):
+        """Queue an ordered text frame."""
+        if self.typed_frames:
+            payload = {"type": frame_type, **payload}
+        self.outbound.put(text_data=json.dumps(payload))
+
+    async def accept_socket(self):
+        # Binary frames for clients that negotiate the compact subprotocol
+        subprotocols = self.scope.get("subprotocols", [])
+        self.binary_frames = location_codec.SUBPROTOCOL in subprotocols
+        if self.binary_frames:
+            await self.accept(subprotocol=location_codec.SUBPROTOCOL)
+        elif AUTH_SUBPROTOCOL in subprotocols:
+            # Token sent as a subprotocol (see rides.middleware)
+            await self.accept(subprotocol=AUTH_SUBPROTOCOL)
+        else:
+            await self.accept()
+
+        # Everything sent from here on goes through a bounded queue
+        self.outbound = OutboundQueue(self.send, self.close)
+        if self.binary_frames:
+            self.epoch_ms = int(time.time() * 1000)
+            self.member_indexes = {}
+            self.outbound.put(text_data=json.dumps({"type": "hello", "epoch": self.epoch_ms}))
+
+    async def join_ride(self):
+        # Status changes on the ride are broadcast here so access is re-checked
+        await self.channel_layer.group_add(
+            access.access_group_name(self.ride_id),
+            self.channel_name
+        )
 
-from .models import RideDetails
+    async def leave_ride(self):
+        if hasattr(self, 'outbound'):
+            self.outbound.close()
+        await self.channel_layer.group_discard(
+            access.access_group_name(self.ride_id),
+            self.channel_name
+        )
 
-User = get_user_model()
+    @db_sync_to_async
+    def get_ride_access_details(self):
+        """
+        Validate user access to the ride location updates.
+        """
+        return access.get_location_access(int(self.ride_id), self.user.id)
 
-class RideLocationConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.user = self.scope["user"]
+    @db_sync_to_async
+    def get_chat_details(self, partner_id):
+        """
+        Validate user access to the ride chat with the given partner.
+        """
+        return access.get_chat_access(int(self.ride_id), self.user.id, int(partner_id))
 
-        # Ensure user is authenticated
-        if not self.user.is_authenticated:
-            await self.close()
+
+class LocationStreamMixin:
+    """The ride's location stream: directed fan-out, throttling, snapshot on join."""
+
+    async def start_location(self, access_details):
+        self.is_driver = access_details['is_driver']
+        # Directed fan-out: the driver hears the passengers, passengers hear the driver
+        if self.is_driver:
+            self.location_group_name = driver_group_name(self.ride_id)
+            self.publish_group_name = passengers_group_name(self.ride_id)
+        else:
+            self.location_group_name = passengers_group_name(self.ride_id)
+            self.publish_group_name = driver_group_name(self.ride_id)
+        self.location_throttle = LocationThrottle(self.publish_location)
+
+        logger.debug("User %s joined %s", self.user.id, self.location_group_name)
+
+        await self.channel_layer.group_add(
+            self.location_group_name,
+            self.channel_name
+        )
+
+        # Last known positions, so a late joiner doesn't wait for the next update
+        await self.send_position_snapshot()
+
+    async def stop_location(self):
+        if not hasattr(self, 'location_throttle'):
             return
+        self.location_throttle.close()
+        del self.location_throttle
+        # Buffered points are written with the next batch, not on every disconnect
+        trails.get_trail_buffer().forget(int(self.ride_id), self.user.id)
 
-        # Extract ride ID from URL
-        self.ride_id = self.scope["url_route"]["kwargs"]["ride_id"]
+        await self.channel_layer.group_discard(
+            self.location_group_name,
+            self.channel_name
+        )
+        logger.debug("User %s left %s", self.user.id, self.location_group_name)
+
+    @db_sync_to_async
+    def get_peer_ids(self):
+        """Members whose positions this connection receives."""
+        snapshot = snapshots.get_snapshot(int(self.ride_id))
+        if snapshot is None:
+            return []
+        if not self.is_driver:
+            return [snapshot["driver_id"]]
+        return [
+            member_id
+            for member_id in snapshot["member_ids"]
+            if member_id != self.user.id
+        ]
+
+    async def send_position_snapshot(self):
+        peer_ids = await self.get_peer_ids()
+        events = await last_positions(int(self.ride_id), peer_ids)
+        # Sent as text in both modes: binary frames can't carry a time before `epoch`
+        self.outbound.put(text_data=json.dumps({
+            "type": "snapshot",
+            "locations": [
+                {**self.location_payload(event), "timestamp": event["timestamp"]}
+                for event in events
+            ],
+        }))
 
-        print(f"User {self.user.email} attempting to connect to ride {self.ride_id}")
+    async def receive_position(self, position):
+        if position is None or not hasattr(self, 'location_throttle'):
+            return
+        # Coalesced to a bounded rate per connection, latest position wins
+        await self.location_throttle.offer(position)
+
+    async def publish_location(self, position):
+        # Buffered in memory, written to the trail table in batches
+        trails.get_trail_buffer().append(int(self.ride_id), self.user.id, position)
+
+        event = {
+            "type": "location_message",
+            **position,
+            "timestamp": int(time.time() * 1000),
+            "user_id": self.user.id,
+            "user_email": self.user.email,
+        }
+        await remember_position(int(self.ride_id), event)
+        await self.channel_layer.group_send(self.publish_group_name, event)
+
+    def location_payload(self, event):
+        message = {
+            "latitude": event["latitude"],
+            "longitude": event["longitude"],
+            "user_id": event["user_id"],
+            "user_email": event["user_email"],
+        }
+        if "heading" in event:
+            message["heading"] = event["heading"]
+            message["speed"] = event["speed"]
+        return message
 
-        # Validate ride access
-        access_details = await self.get_ride_access_details()
-        if not access_details['has_access']:
-            print(f"Access Denied for user {self.user.email} to ride {self.ride_id}")
-            await self.close()
+    async def location_message(self, event):
+        # Only the newest position per sender is kept if the client falls behind
+        if self.binary_frames:
+            self.send_binary_location(event)
             return
 
-        self.is_driver = access_details['is_driver']
-        self.room_group_name = f"ride_location_{self.ride_id}"
+        payload = self.location_payload(event)
+        if self.typed_frames:
+            payload = {"type": "location", **payload}
+        self.outbound.put_latest(event["user_id"], text_data=json.dumps(payload))
+
+    def send_binary_location(self, event):
+        index = self.member_indexes.get(event["user_id"])
+        if index is None:
+            # First frame from this sender: send the index -> user mapping once
+            index = self.member_indexes[event["user_id"]] = len(self.member_indexes)
+            self.outbound.put(text_data=json.dumps({
+                "type": "member",
+                "index": index,
+                "user_id": event["user_id"],
+                "user_email": event["user_email"],
+            }))
+        elapsed_ms = event.get("timestamp", self.epoch_ms) - self.epoch_ms
+        self.outbound.put_latest(
+            event["user_id"],
+            bytes_data=location_codec.encode_position(index, event, elapsed_ms),
+        )
+
+
+class ChatStreamMixin:
+    """Chat threads between the driver and each confirmed passenger."""
 
-        print(f"User {self.user.email} connecting to room {self.room_group_name}")
+    async def start_chat(self, partner_id, chat_details):
+        if not hasattr(self, 'chats'):
+            self.chats = {}
+            # Chat events carry the sender's email; this covers events that don't
+            self.participant_emails = {self.user.id: self.user.email}
+        group_name = chat_group_name(self.ride_id, self.user.id, partner_id)
+        self.chats[partner_id] = {"group": group_name, "is_driver": chat_details['is_driver']}
+        self.participant_emails[partner_id] = chat_details.get('partner_email')
+
+        logger.debug("User %s joined %s", self.user.id, group_name)
 
-        # Join room group
         await self.channel_layer.group_add(
-            self.room_group_name,
+            group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.send_chat_notice(partner_id, "connected")
 
-    @database_sync_to_async
-    def get_ride_access_details(self):
-        """
-        Validate user access to the ride location updates.
-        """
-        try:
-            ride = RideDetails.objects.get(id=self.ride_id)
-
-            # Check if the user is the driver
-            if ride.driver == self.user:
-                print(f"User {self.user.email} is the driver of ride {self.ride_id}")
-                return {'has_access': True, 'is_driver': True}
-
-            # Check if the user is a confirmed passenger
-            passenger_request = PassengerRideRequest.objects.filter(
-                ride=ride,
-                passenger=self.user,
-                status__in=['CONFIRMED', 'IN_VEHICLE']
-            ).first()
-            if passenger_request:
-                print(f"User {self.user.email} is a confirmed passenger of ride {self.ride_id}")
-                return {'has_access': True, 'is_driver': False}
-
-            print(f"User {self.user.email} is neither the driver nor a confirmed passenger of ride {self.ride_id}")
-            return {'has_access': False, 'is_driver': False}
-
-        except RideDetails.DoesNotExist:
-            print(f"Ride {self.ride_id} does not exist")
-            return {'has_access': False, 'is_driver': False}
+    async def stop_chat(self, partner_id):
+        chat = getattr(self, 'chats', {}).pop(partner_id, None)
+        if chat is None:
+            return
+        await self.send_chat_notice(partner_id, "disconnected", chat)
+        await self.channel_layer.group_discard(
+            chat["group"],
+            self.channel_name
+        )
+        logger.debug("User %s left %s", self.user.id, chat["group"])
 
-    async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
-            print(f"User {self.user.email} disconnected from room {self.room_group_name}")
+    async def send_chat_notice(self, partner_id, action, chat=None):
+        chat = chat or self.chats[partner_id]
+        await self.channel_layer.group_send(
+            chat["group"],
+            {
+                "type": "chat_message",
+                "message": f"{'Driver' if chat['is_driver'] else 'Passenger'} {action}",
+                "user_id": self.user.id,
+                "user_email": self.user.email,
+                "receiver_id": partner_id,
+                "timestamp": timezone.now().isoformat()
+            }
+        )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        latitude = data.get("latitude")
-        longitude = data.get("longitude")
+    async def send_chat(self, partner_id, data):
+        chat = getattr(self, 'chats', {}).get(partner_id)
+        if chat is None:
+            return
+        message = str(data.get("message", "")).strip()
 
-        print(f"Received location update from user {self.user.email}: {latitude}, {longitude}")
+        # Validate message length and content
+        if not message or len(message) > 1000:
+            return  # Ignore invalid messages
 
+        logger.debug("Chat message from user %s in ride %s", self.user.id, self.ride_id)
+
+        # A client re-sending after a reconnect reuses its id: stored and sent once
+        try:
+            message_id = uuid.UUID(str(data["message_id"]))
+        except (KeyError, ValueError):
+            message_id = uuid.uuid4()
+        else:
+            if not await claim_message_id(self.user.id, message_id):
+                return
+        timestamp = timezone.now()
+
+        # Persisted in the background in batches (see rides.chat_outbox)
+        get_chat_outbox().append(
+            message_id=message_id,
+            ride_id=self.ride_id,
+            sender_id=self.user.id,
+            receiver_id=partner_id,
+            message=message,
+            timestamp=timestamp,
+        )
+
+        # Broadcast the message to the group
         await self.channel_layer.group_send(
-            self.room_group_name,
+            chat["group"],
             {
-                "type": "location_message",
-                "latitude": latitude,
-                "longitude": longitude,
+                "type": "chat_message",
+                "message_id": str(message_id),
+                "message": message,
                 "user_id": self.user.id,
                 "user_email": self.user.email,
+                "receiver_id": partner_id,
+                "timestamp": timestamp.isoformat()
             }
         )
 
-    async def location_message(self, event):
-        await self.send(text_data=json.dumps({
-            "latitude": event["latitude"],
-            "longitude": event["longitude"],
+    async def chat_message(self, event):
+        """
+        Handle broadcasting messages to WebSocket clients.
+        """
+        sender_email = (
+            event.get("user_email")
+            or self.participant_emails.get(event["user_id"])
+            or "Unknown"
+        )
+        payload = {
+            "message_id": event.get("message_id"),
+            "message": event["message"],
             "user_id": event["user_id"],
-            "user_email": event["user_email"],
-        }))
+            "user_email": sender_email,
+            "timestamp": event["timestamp"]
+        }
+        if self.typed_frames:
+            # Which thread this belongs to, from this socket's point of view
+            payload["partner_id"] = (
+                event.get("receiver_id")
+                if event["user_id"] == self.user.id
+                else event["user_id"]
+            )
 
+        # Queued in order; a client that falls too far behind is disconnected
+        self.send_frame("chat", payload)
 
 
+class RideLocationConsumer(LocationStreamMixin, RideSocketMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope["user"]
 
-User = get_user_model()
+        # Ensure user is authenticated
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # Extract ride ID from URL
+        self.ride_id = self.scope["url_route"]["kwargs"]["ride_id"]
+
+        logger.debug("User %s connecting to ride %s", self.user.id, self.ride_id)
+
+        # Validate ride access
+        access_details = await self.get_ride_access_details()
+        if not access_details['has_access']:
+            logger.debug("Access denied for user %s to ride %s", self.user.id, self.ride_id)
+            await self.close()
+            return
 
-class RideChatConsumer(AsyncWebsocketConsumer):
+        await self.join_ride()
+        await self.accept_socket()
+        await self.start_location(access_details)
+
+    async def access_changed(self, event):
+        """
+        A status on this ride changed: re-check and drop the socket if access was lost.
+        """
+        access_details = await self.get_ride_access_details()
+        if not access_details['has_access']:
+            logger.debug("Access revoked for user %s to ride %s", self.user.id, self.ride_id)
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'outbound'):
+            await self.stop_location()
+            await self.leave_ride()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            position = location_codec.decode_position(bytes_data)
+            if position is not None:
+                position = parse_position(position)
+        else:
+            try:
+                data = json.loads(text_data)
+            except json.JSONDecodeError:
+                return
+            position = parse_position(data) if isinstance(data, dict) else None
+
+        await self.receive_position(position)
+
+
+class RideChatConsumer(ChatStreamMixin, RideSocketMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
 
@@ -133,176 +400,194 @@ class RideChatConsumer(AsyncWebsocketConsumer):
         self.ride_id = self.scope["url_route"]["kwargs"]["ride_id"]
         self.partner_id = self.scope["url_route"]["kwargs"]["partner_id"]
 
-        print(f"User {self.user.id} attempting to connect to ride {self.ride_id} with partner {self.partner_id}")
+        logger.debug(
+            "User %s connecting to ride %s chat with %s", self.user.id, self.ride_id, self.partner_id
+        )
 
         # Validate chat access
-        chat_details = await self.get_chat_details()
+        chat_details = await self.get_chat_details(self.partner_id)
         if not chat_details['has_access']:
-            print(f"Access denied for user {self.user.id} to ride {self.ride_id}")
+            logger.debug("Access denied for user %s to ride %s", self.user.id, self.ride_id)
             await self.close()
             return
 
-        self.is_driver = chat_details['is_driver']
-
-        # Create room group name for each driver-passenger pair
-        self.room_group_name = f"chat_ride_{self.ride_id}_user_{min(self.user.id, self.partner_id)}_{max(self.user.id, self.partner_id)}"
-
-        print(f"User {self.user.id} connecting to room {self.room_group_name}")
+        await self.join_ride()
+        await self.accept_socket()
+        await self.start_chat(self.partner_id, chat_details)
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
-
-        # Notify about the connection
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": f"{'Driver' if self.is_driver else 'Passenger'} connected",
-                "user_id": self.user.id,
-                
-                "timestamp": timezone.now().isoformat()
-            }
-        )
-
-    @database_sync_to_async
-    def get_chat_details(self):
+    async def access_changed(self, event):
         """
-        Validate user access to the ride chat and determine the chat partner.
+        A status on this ride changed: re-check and drop the socket if access was lost.
         """
-        try:
-            ride = RideDetails.objects.get(id=self.ride_id)
-            partner = User.objects.get(id=self.partner_id)
-
-            # Check if the user is the driver and the partner is a confirmed passenger
-            if ride.driver == self.user:
-                passenger_request = PassengerRideRequest.objects.filter(
-                    ride=ride,
-                    passenger=partner,
-                    status__in=['CONFIRMED', 'IN_VEHICLE']
-                ).first()
-                if passenger_request:
-                    print(f"Driver {self.user.id} found confirmed passenger {partner.id} for ride {self.ride_id}")
-                    return {'has_access': True, 'is_driver': True}
-                else:
-                    print(f"No confirmed or in-vehicle passenger found for driver {self.user.id} and partner {partner.id}")
-
-            # Check if the user is a confirmed passenger and the partner is the driver
-            if partner == ride.driver:
-                passenger_request = PassengerRideRequest.objects.filter(
-                    ride=ride,
-                    passenger=self.user,
-                    status__in=['CONFIRMED', 'IN_VEHICLE']
-                ).first()
-                if passenger_request:
-                    print(f"Passenger {self.user.id} confirmed for ride {self.ride_id} with driver {partner.id}")
-                    return {'has_access': True, 'is_driver': False}
-                else:
-                    print(f"No confirmed or in-vehicle status for passenger {self.user.id} in ride {self.ride_id}")
-
-            print(f"Access denied: user {self.user.id} is not the driver or a confirmed passenger in ride {self.ride_id}")
-            return {'has_access': False, 'is_driver': False}
-
-        except RideDetails.DoesNotExist:
-            print(f"Ride {self.ride_id} does not exist")
-            return {'has_access': False, 'is_driver': False}
-
-        except User.DoesNotExist:
-            print(f"Partner {self.partner_id} does not exist")
-            return {'has_access': False, 'is_driver': False}
+        chat_details = await self.get_chat_details(self.partner_id)
+        if not chat_details['has_access']:
+            logger.debug("Access revoked for user %s to ride %s", self.user.id, self.ride_id)
+            await self.close()
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
-            # Notify about the disconnection
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": f"{'Driver' if self.is_driver else 'Passenger'} disconnected",
-                    "user_id": self.user.id,
-                    
-                    "timestamp": timezone.now().isoformat()
-                }
-            )
-
-            # Leave room group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
-            print(f"User {self.user.id} disconnected from room {self.room_group_name}")
+        if hasattr(self, 'outbound'):
+            await self.stop_chat(self.partner_id)
+            await self.leave_ride()
 
     async def receive(self, text_data):
         try:
-            # Parse incoming data
             data = json.loads(text_data)
-            message = data.get("message", "").strip()
-
-            # Validate message length and content
-            if not message or len(message) > 1000:
-                return  # Ignore invalid messages
-
-            print(f"Received message from user {self.user.id}: {message}")
-
-            # Save the message to the database
-            await self.save_message(message)
-
-            # Broadcast the message to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": message,
-                    "user_id": self.user.id,
-                    
-                    "timestamp": timezone.now().isoformat()
-                }
-            )
-
         except json.JSONDecodeError:
-            print("Invalid JSON received")
-            await self.send(json.dumps({"error": "Invalid message format"}))
-        except Exception as e:
-            print(f"Error in receive: {e}")
+            logger.debug("Invalid JSON from user %s", self.user.id)
+            self.send_frame("error", {"error": "Invalid message format"})
+            return
+        if not isinstance(data, dict):
+            return
 
-    @database_sync_to_async
-    def save_message(self, message):
-        """
-        Save the message to the database.
-        """
-        ChatMessage.objects.create(
-            ride_id=self.ride_id,
-            sender=self.user,
-            receiver_id=self.partner_id,
-            message=message
-        )
-        print(f"Message saved to database: {message[:50]}...")
+        try:
+            await self.send_chat(self.partner_id, data)
+        except Exception:
+            logger.exception("Chat message from user %s could not be sent", self.user.id)
 
-    async def chat_message(self, event):
-        """
-        Handle broadcasting messages to WebSocket clients.
-        """
-        sender_email = await self.get_user_email(event["user_id"])
 
-        # Send the message to WebSocket
-        await self.send(json.dumps({
-            "message": event["message"],
-            "user_id": event["user_id"],
-            "user_email": sender_email,
-            
-            "timestamp": event["timestamp"]
-        }))
+class RideStreamConsumer(LocationStreamMixin, ChatStreamMixin, RideSocketMixin, AsyncWebsocketConsumer):
+    """
+    One socket per rider per ride, multiplexing the location stream and every
+    chat thread of the ride. Frames are JSON objects with a "type":
+
+    client -> server
+        {"type": "subscribe", "stream": "location"}
+        {"type": "subscribe", "stream": "chat", "partner_id": 12}
+        {"type": "unsubscribe", "stream": "location" | "chat", ["partner_id"]}
+        {"type": "location", "latitude": .., "longitude": .., ["heading", "speed"]}
+        {"type": "chat", "partner_id": 12, "message": "..", ["message_id"]}
+
+    server -> client
+        ready, subscribed, unsubscribed, error, snapshot, location, chat
+        (chat frames carry the partner_id of their thread)
+
+    Binary location frames work as on ws/rides/<id>/location/ when the
+    client negotiates the same subprotocol.
+    """
+
+    typed_frames = True
+
+    async def connect(self):
+        self.user = self.scope["user"]
+
+        # Ensure user is authenticated
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.ride_id = self.scope["url_route"]["kwargs"]["ride_id"]
 
-    @database_sync_to_async
-    def get_user_email(self, user_id):
+        # Only the driver and confirmed passengers get a stream at all
+        self.access_details = await self.get_ride_access_details()
+        if not self.access_details['has_access']:
+            logger.debug("Access denied for user %s to ride %s", self.user.id, self.ride_id)
+            await self.close()
+            return
+
+        await self.join_ride()
+        await self.accept_socket()
+        self.send_frame("ready", {
+            "ride_id": int(self.ride_id),
+            "is_driver": self.access_details['is_driver'],
+        })
+
+    async def access_changed(self, event):
         """
-        Retrieve the user's email address by ID.
+        A status on this ride changed: close the socket if the rider lost
+        access to the ride, otherwise drop only the chat threads that ended.
         """
+        self.access_details = await self.get_ride_access_details()
+        if not self.access_details['has_access']:
+            logger.debug("Access revoked for user %s to ride %s", self.user.id, self.ride_id)
+            await self.close()
+            return
+
+        for partner_id in list(getattr(self, 'chats', {})):
+            chat_details = await self.get_chat_details(partner_id)
+            if not chat_details['has_access']:
+                await self.stop_chat(partner_id)
+                self.send_frame("unsubscribed", {
+                    "stream": "chat",
+                    "partner_id": partner_id,
+                    "reason": "access_revoked",
+                })
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'outbound'):
+            await self.stop_location()
+            for partner_id in list(getattr(self, 'chats', {})):
+                await self.stop_chat(partner_id)
+            await self.leave_ride()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            position = location_codec.decode_position(bytes_data)
+            if position is not None:
+                await self.receive_position(parse_position(position))
+            return
+
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
+            self.send_frame("error", {"error": "Invalid message format"})
+            return
+
+        frame_type = data.get("type")
+        if frame_type == "location":
+            await self.receive_position(parse_position(data))
+        elif frame_type == "chat":
+            partner_id = self.get_partner_id(data)
+            if partner_id not in getattr(self, 'chats', {}):
+                self.send_frame("error", {"error": "Not subscribed to this chat"})
+                return
+            await self.send_chat(partner_id, data)
+        elif frame_type == "subscribe":
+            await self.subscribe(data)
+        elif frame_type == "unsubscribe":
+            await self.unsubscribe(data)
+        else:
+            self.send_frame("error", {"error": f"Unknown frame type: {frame_type}"})
+
+    def get_partner_id(self, data):
         try:
-            user = User.objects.get(id=user_id)
-            return user.email
-        except User.DoesNotExist:
-            return "Unknown"
+            return int(data["partner_id"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def subscribe(self, data):
+        stream = data.get("stream")
+        if stream == "location":
+            self.send_frame("subscribed", {"stream": "location"})
+            if not hasattr(self, 'location_throttle'):
+                await self.start_location(self.access_details)
+        elif stream == "chat":
+            partner_id = self.get_partner_id(data)
+            if partner_id is None:
+                self.send_frame("error", {"error": "partner_id is required"})
+                return
+            if partner_id not in getattr(self, 'chats', {}):
+                chat_details = await self.get_chat_details(partner_id)
+                if not chat_details['has_access']:
+                    self.send_frame("error", {
+                        "error": "No chat access with this user",
+                        "partner_id": partner_id,
+                    })
+                    return
+                await self.start_chat(partner_id, chat_details)
+            self.send_frame("subscribed", {"stream": "chat", "partner_id": partner_id})
+        else:
+            self.send_frame("error", {"error": f"Unknown stream: {stream}"})
+
+    async def unsubscribe(self, data):
+        stream = data.get("stream")
+        if stream == "location":
+            await self.stop_location()
+            self.send_frame("unsubscribed", {"stream": "location"})
+        elif stream == "chat":
+            partner_id = self.get_partner_id(data)
+            await self.stop_chat(partner_id)
+            self.send_frame("unsubscribed", {"stream": "chat", "partner_id": partner_id})
+        else:
+            self.send_frame("error", {"error": f"Unknown stream: {stream}"})
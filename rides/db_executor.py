@@ -0,0 +1,85 @@
+"""
+Bounded thread pool for the database work of WebSocket consumers.
+
+database_sync_to_async is thread-sensitive by default: every call from every
+socket in a process runs on the one shared sync thread, which then caps how
+many handshakes (access checks, principal loads) a worker can do at once.
+Django's async ORM methods (aget, afirst, ...) are the same calls behind
+thread-sensitive sync_to_async, so they don't lift that cap either.
+
+db_sync_to_async runs the function on a pool of RIDE_WS_DB_THREADS threads
+instead. Each thread keeps its own connection for RIDE_WS_DB_CONN_MAX_AGE
+seconds (health-checked before reuse), so the pool is also a bounded
+connection pool: a worker opens at most RIDE_WS_DB_THREADS connections for
+its sockets. Only the pool threads get the longer lifetime; HTTP requests
+keep the project's CONN_MAX_AGE. RIDE_WS_DB_THREADS = 0 falls back to the
+thread-sensitive behaviour.
+
+The same holds for the cache: Django's RedisCache has no native async
+methods, so cache.aget and friends are the sync calls behind thread-sensitive
+sync_to_async too. pool_sync_to_async runs any other blocking call (see
+rides.ws_cache) on the pool without the connection housekeeping.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connections
+
+_lock = threading.Lock()
+_executors = {}
+
+
+def _init_thread():
+    for alias in connections:
+        connection = connections[alias]
+        # The wrapper is local to this thread, so the override is too
+        connection.settings_dict = {
+            **connection.settings_dict,
+            "CONN_MAX_AGE": settings.RIDE_WS_DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+        }
+
+
+def get_db_executor():
+    """The pool for the configured size, or None when it is disabled."""
+    size = settings.RIDE_WS_DB_THREADS
+    if size <= 0:
+        return None
+    with _lock:
+        if size not in _executors:
+            _executors[size] = ThreadPoolExecutor(
+                max_workers=size,
+                thread_name_prefix="ride-db",
+                initializer=_init_thread,
+            )
+        return _executors[size]
+
+
+def db_sync_to_async(func):
+    """Like database_sync_to_async, but on the bounded database pool."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor = get_db_executor()
+        return await database_sync_to_async(
+            func, thread_sensitive=executor is None, executor=executor
+        )(*args, **kwargs)
+
+    return wrapper
+
+
+def pool_sync_to_async(func):
+    """Like sync_to_async, but on the bounded pool; for blocking calls that aren't queries."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor = get_db_executor()
+        return await sync_to_async(
+            func, thread_sensitive=executor is None, executor=executor
+        )(*args, **kwargs)
+
+    return wrapper
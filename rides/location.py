@@ -0,0 +1,159 @@
+"""
+Helpers for the ride location stream (RideLocationConsumer).
+"""
+import asyncio
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+from rides import ws_cache
+from rides.spatial_index import haversine_m
+
+
+def parse_position(data):
+    """Validated position dict from a client frame, or None if unusable."""
+    try:
+        latitude = float(data["latitude"])
+        longitude = float(data["longitude"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    position = {"latitude": latitude, "longitude": longitude}
+
+    # Optional motion: heading in degrees, speed in m/s
+    try:
+        heading = float(data["heading"])
+        speed = float(data["speed"])
+    except (KeyError, TypeError, ValueError):
+        return position
+    if math.isfinite(heading) and math.isfinite(speed) and speed >= 0:
+        position["heading"] = heading % 360
+        position["speed"] = speed
+    return position
+
+
+class LocationThrottle:
+    """
+    Per-connection update policy for outgoing location frames.
+
+    At most one position is published per `min_interval` seconds. Positions
+    offered inside the window replace each other (latest wins) and the newest
+    one is flushed by a timer when the window closes. A position closer than
+    `min_displacement` metres to the last published one is dropped, unless
+    nothing was published for `max_silence` seconds: a parked vehicle still
+    refreshes its last known position (see remember_position) before it
+    expires.
+    """
+
+    def __init__(self, publish, min_interval=None, min_displacement=None, max_silence=None):
+        self.publish = publish
+        self.min_interval = (
+            settings.RIDE_LOCATION_MIN_INTERVAL if min_interval is None else min_interval
+        )
+        self.min_displacement = (
+            settings.RIDE_LOCATION_MIN_DISPLACEMENT
+            if min_displacement is None
+            else min_displacement
+        )
+        self.max_silence = (
+            settings.RIDE_LOCATION_MAX_SILENCE if max_silence is None else max_silence
+        )
+        self._pending = None
+        self._last_sent = None
+        self._last_sent_at = None
+        self._timer = None
+        self.dropped = 0
+
+    async def offer(self, position):
+        if self._pending is not None:
+            self.dropped += 1
+        self._pending = position
+
+        loop = asyncio.get_running_loop()
+        wait = (
+            0
+            if self._last_sent_at is None
+            else self._last_sent_at + self.min_interval - loop.time()
+        )
+        if wait <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(wait))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        position, self._pending = self._pending, None
+        if position is None:
+            return
+        now = asyncio.get_running_loop().time()
+        if self._last_sent is not None and self.min_displacement > 0:
+            moved = haversine_m(
+                (self._last_sent["longitude"], self._last_sent["latitude"]),
+                (position["longitude"], position["latitude"]),
+            )
+            if moved < self.min_displacement and now - self._last_sent_at < self.max_silence:
+                self.dropped += 1
+                return
+        self._last_sent = position
+        self._last_sent_at = now
+        await self.publish(position)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = None
+
+
+def driver_group_name(ride_id):
+    """Group the driver listens on: passengers' positions."""
+    return f"ride_location_{ride_id}_driver"
+
+
+def passengers_group_name(ride_id):
+    """Group the passengers listen on: the driver's position."""
+    return f"ride_location_{ride_id}_passengers"
+
+
+def last_position_key(ride_id, user_id):
+    return f"rides:location:last:{ride_id}:{user_id}"
+
+
+async def remember_position(ride_id, event):
+    """Keep the latest published location event of a rider for late joiners."""
+    await ws_cache.aset(
+        last_position_key(ride_id, event["user_id"]),
+        event,
+        timeout=settings.RIDE_LOCATION_LAST_TTL,
+    )
+
+
+async def last_positions(ride_id, user_ids):
+    """Latest known location events of the given riders, oldest first."""
+    found = await ws_cache.aget_many(
+        [last_position_key(ride_id, user_id) for user_id in user_ids]
+    )
+    return sorted(found.values(), key=lambda event: event["timestamp"])
+
+
+def forget_ride(ride_id):
+    """Drop the last known positions of a finished ride."""
+    from rides.models import PassengerRideRequest, RideDetails
+
+    user_ids = set(
+        PassengerRideRequest.objects.filter(ride_id=ride_id).values_list(
+            "passenger_id", flat=True
+        )
+    )
+    user_ids.update(
+        RideDetails.objects.filter(id=ride_id).values_list("driver_id", flat=True)
+    )
+    cache.delete_many([last_position_key(ride_id, user_id) for user_id in user_ids])
@@ -0,0 +1,68 @@
+"""
+Compact binary encoding for the ride location stream.
+
+Clients that offer the ``voy.location.v1`` WebSocket subprotocol get location
+frames as fixed-layout binary messages instead of JSON text. Each frame is
+little-endian:
+
+    uint8   frame type (1 = position)
+    uint8   flags (bit 0: heading and speed present)
+    uint16  sender index (see below)
+    int32   latitude in micro-degrees
+    int32   longitude in micro-degrees
+    uint32  milliseconds since the connection's epoch
+    [uint16 heading in tenths of a degree, uint16 speed in cm/s]
+
+Senders are identified by a small per-connection index. The index -> user
+mapping is sent as a JSON text frame ``{"type": "member", ...}`` the first
+time a sender appears on that connection (the connection's epoch is sent in a
+``{"type": "hello", ...}`` frame right after accept). Clients may send their
+own positions in the same format; the sender index is ignored.
+"""
+import struct
+
+SUBPROTOCOL = "voy.location.v1"
+
+FRAME_POSITION = 1
+FLAG_MOTION = 0x01
+
+_HEADER = struct.Struct("<BBHiiI")
+_MOTION = struct.Struct("<HH")
+MICRO = 1_000_000
+
+
+def encode_position(index, position, elapsed_ms):
+    heading = position.get("heading")
+    speed = position.get("speed")
+    has_motion = heading is not None and speed is not None
+    frame = _HEADER.pack(
+        FRAME_POSITION,
+        FLAG_MOTION if has_motion else 0,
+        index & 0xFFFF,
+        round(position["latitude"] * MICRO),
+        round(position["longitude"] * MICRO),
+        max(0, min(int(elapsed_ms), 0xFFFFFFFF)),
+    )
+    if has_motion:
+        frame += _MOTION.pack(
+            round((heading % 360) * 10) % 3600,
+            max(0, min(round(speed * 100), 0xFFFF)),
+        )
+    return frame
+
+
+def decode_position(frame):
+    """Position dict from a client frame, or None if it is not a valid frame."""
+    if len(frame) < _HEADER.size:
+        return None
+    frame_type, flags, _index, latitude, longitude, elapsed_ms = _HEADER.unpack_from(frame)
+    if frame_type != FRAME_POSITION:
+        return None
+    position = {"latitude": latitude / MICRO, "longitude": longitude / MICRO}
+    if flags & FLAG_MOTION:
+        if len(frame) < _HEADER.size + _MOTION.size:
+            return None
+        heading, speed = _MOTION.unpack_from(frame, _HEADER.size)
+        position["heading"] = heading / 10
+        position["speed"] = speed / 100
+    return position
@@ -0,0 +1,137 @@
+import asyncio
+import random
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rides.channel_layers import ShardedRedisChannelLayer
+from rides.location import passengers_group_name
+
+
+def run_client(hosts, prefix, client, options):
+    return asyncio.run(_client(hosts, prefix, client, options))
+
+
+async def _client(hosts, prefix, client, options):
+    # Several layer instances stand in for several ASGI workers, so member
+    # channels are spread over the shards like they are in production
+    workers = [
+        ShardedRedisChannelLayer(hosts=hosts, prefix=prefix, capacity=1000)
+        for _ in range(options["workers"])
+    ]
+    sender = workers[0]
+    ride_ids = [client * options["rides"] + index for index in range(options["rides"])]
+
+    delivered = 0
+
+    async def drain(layer, channel):
+        nonlocal delivered
+        while True:
+            await layer.receive(channel)
+            delivered += 1
+
+    receivers = []
+    for ride_id in ride_ids:
+        for member in range(options["members"]):
+            layer = workers[(ride_id + member) % len(workers)]
+            channel = await layer.new_channel()
+            await layer.group_add(passengers_group_name(ride_id), channel)
+            receivers.append(asyncio.ensure_future(drain(layer, channel)))
+
+    sent = 0
+    rng = random.Random(client)
+    deadline = time.perf_counter() + options["seconds"]
+
+    async def send():
+        nonlocal sent
+        while time.perf_counter() < deadline:
+            ride_id = rng.choice(ride_ids)
+            await sender.group_send(
+                passengers_group_name(ride_id),
+                {
+                    "type": "location_message",
+                    "latitude": 28.6,
+                    "longitude": 77.2,
+                    "timestamp": sent,
+                    "user_id": ride_id,
+                },
+            )
+            sent += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(options["concurrency"])))
+    elapsed = time.perf_counter() - started
+    # Let the receivers catch up with what is already in Redis
+    await asyncio.sleep(0.5)
+
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    for layer in workers:
+        await layer.close_pools()
+    return sent, delivered, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        "group_send throughput of the sharded channel layer with 1, 2, .. N of "
+        "the given Redis hosts. Needs the hosts running (e.g. docker compose "
+        "--profile shards up); keys are written under a throwaway prefix and "
+        "flushed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hosts",
+            help="Comma-separated Redis URLs (default: CHANNEL_LAYER_HOSTS)",
+        )
+        parser.add_argument("--rides", type=int, default=200, help="Rides per client process")
+        parser.add_argument("--members", type=int, default=4, help="Sockets per ride group")
+        parser.add_argument("--workers", type=int, default=4, help="Simulated ASGI workers per client")
+        parser.add_argument("--concurrency", type=int, default=50, help="Concurrent senders per client")
+        parser.add_argument("--processes", type=int, default=4, help="Client processes generating load")
+        parser.add_argument("--seconds", type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        hosts = (
+            options["hosts"].split(",") if options["hosts"] else list(settings.CHANNEL_LAYER_HOSTS)
+        )
+
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        placement = Counter(
+            layer.consistent_hash(passengers_group_name(ride_id)) for ride_id in range(10000)
+        )
+        self.stdout.write(
+            "ride placement over 10,000 rides: "
+            + ", ".join(f"shard {shard}: {placement[shard]}" for shard in range(len(hosts)))
+        )
+
+        baseline = None
+        for shard_count in range(1, len(hosts) + 1):
+            prefix = f"bench-{uuid.uuid4().hex[:8]}"
+            shard_hosts = hosts[:shard_count]
+            try:
+                with ProcessPoolExecutor(options["processes"]) as pool:
+                    results = list(pool.map(
+                        run_client,
+                        [shard_hosts] * options["processes"],
+                        [prefix] * options["processes"],
+                        range(options["processes"]),
+                        [options] * options["processes"],
+                    ))
+            finally:
+                asyncio.run(ShardedRedisChannelLayer(hosts=shard_hosts, prefix=prefix).flush())
+
+            sent = sum(result[0] for result in results)
+            delivered = sum(result[1] for result in results)
+            elapsed = max(result[2] for result in results)
+            rate = sent / elapsed
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{shard_count} shard(s): {rate:,.0f} group_send/sec, "
+                f"{delivered / elapsed:,.0f} deliveries/sec ({rate / baseline:.2f}x)"
+            )
@@ -0,0 +1,80 @@
+import asyncio
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from authentication.models import User
+from rides.chat_outbox import ChatOutbox
+from rides.management.seeding import seed_rides, seed_users
+from rides.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Chat messages per second one worker persists: an awaited create() per "
+        "message (the old consumer path) versus the write-behind outbox. The "
+        "outbox flushes on its own threads and commits, so the seeded users, "
+        "ride and messages are deleted afterwards instead of rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--flush-size", type=int, default=50)
+        parser.add_argument("--flush-interval", type=float, default=0.25)
+
+    def handle(self, *args, **options):
+        users = seed_users(2, prefix="chat-bench")
+        try:
+            ride = seed_rides(1, users[:1])[0]
+            lines = asyncio.run(self.run(ride, *users, options))
+        finally:
+            # Cascades to the ride and its messages
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        for line in lines:
+            self.stdout.write(line)
+
+    async def run(self, ride, driver, passenger, options):
+        count = options["messages"]
+
+        def message(index):
+            return {
+                "message_id": uuid.uuid4(),
+                "ride_id": ride.id,
+                "sender_id": driver.id,
+                "receiver_id": passenger.id,
+                "message": f"benchmark message {index}",
+                "timestamp": timezone.now(),
+            }
+
+        create = database_sync_to_async(ChatMessage.objects.create)
+        started = time.perf_counter()
+        for index in range(count):
+            await create(**message(index))
+        direct = time.perf_counter() - started
+
+        outbox = ChatOutbox(
+            flush_size=options["flush_size"], flush_interval=options["flush_interval"]
+        )
+        started = time.perf_counter()
+        for index in range(count):
+            outbox.append(**message(index))
+            # Let the event loop run, as it would between websocket frames
+            await asyncio.sleep(0)
+        accepted = time.perf_counter() - started
+        await outbox.flush_now()
+        persisted = time.perf_counter() - started
+
+        stored = await database_sync_to_async(
+            ChatMessage.objects.filter(ride_id=ride.id).count
+        )()
+        return [
+            f"create() per message: {count / direct:,.0f} msgs/sec",
+            f"outbox: {count / accepted:,.0f} msgs/sec accepted, "
+            f"{count / persisted:,.0f} msgs/sec persisted "
+            f"(batches of {options['flush_size']})",
+            f"rows stored: {stored} of {2 * count}",
+        ]
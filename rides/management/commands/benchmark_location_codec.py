@@ -0,0 +1,58 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from rides import location_codec
+
+
+class Command(BaseCommand):
+    help = "Compare bytes and CPU time per location frame for JSON and the binary subprotocol."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=100000)
+        parser.add_argument("--motion", action="store_true", help="Include heading/speed")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        events = []
+        for index in range(options["frames"]):
+            event = {
+                "latitude": 28.6 + rng.uniform(-0.1, 0.1),
+                "longitude": 77.2 + rng.uniform(-0.1, 0.1),
+                "timestamp": 1_700_000_000_000 + index * 1000,
+                "user_id": 1000 + index % 8,
+                "user_email": f"rider{index % 8}@example.com",
+            }
+            if options["motion"]:
+                event["heading"] = rng.uniform(0, 360)
+                event["speed"] = rng.uniform(0, 30)
+            events.append(event)
+        epoch = events[0]["timestamp"]
+
+        def encode_json(event):
+            message = {
+                "latitude": event["latitude"],
+                "longitude": event["longitude"],
+                "user_id": event["user_id"],
+                "user_email": event["user_email"],
+            }
+            if "heading" in event:
+                message["heading"] = event["heading"]
+                message["speed"] = event["speed"]
+            return json.dumps(message).encode()
+
+        def encode_binary(event):
+            return location_codec.encode_position(
+                event["user_id"] - 1000, event, event["timestamp"] - epoch
+            )
+
+        for label, encode in (("json", encode_json), ("binary", encode_binary)):
+            started = time.process_time()
+            total_bytes = sum(len(encode(event)) for event in events)
+            cpu = time.process_time() - started
+            self.stdout.write(
+                f"{label}: {total_bytes / len(events):.1f} bytes/frame, "
+                f"{cpu / len(events) * 1e6:.2f} us CPU/frame"
+            )
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from rides.location import driver_group_name, passengers_group_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Channel-layer deliveries per second for one ride: every member in one "
+        "shared group versus the directed driver/passenger groups."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seats", type=int, default=8, help="Passengers on the ride")
+        parser.add_argument("--updates", type=int, default=500, help="Updates per member")
+
+    def handle(self, *args, **options):
+        for label in ("shared", "directed"):
+            deliveries, elapsed = asyncio.run(
+                self.run(label, options["seats"], options["updates"])
+            )
+            rounds = options["updates"]
+            self.stdout.write(
+                f"{label}: {deliveries / rounds:.0f} deliveries per update round, "
+                f"{deliveries} in {elapsed:.2f}s ({deliveries / elapsed:,.0f} msgs/sec)"
+            )
+
+    async def run(self, label, seats, updates):
+        layer = InMemoryChannelLayer(capacity=seats * updates * (seats + 1) + 1)
+        ride_id = 1
+        members = []
+        for index in range(seats + 1):
+            channel = await layer.new_channel()
+            is_driver = index == 0
+            if label == "shared":
+                listen = publish = f"ride_location_{ride_id}"
+            elif is_driver:
+                listen = driver_group_name(ride_id)
+                publish = passengers_group_name(ride_id)
+            else:
+                listen = passengers_group_name(ride_id)
+                publish = driver_group_name(ride_id)
+            await layer.group_add(listen, channel)
+            members.append((index, channel, publish))
+
+        started = time.perf_counter()
+        for update in range(updates):
+            for user_id, _channel, publish in members:
+                await layer.group_send(
+                    publish,
+                    {
+                        "type": "location_message",
+                        "latitude": 28.6,
+                        "longitude": 77.2,
+                        "timestamp": update,
+                        "user_id": user_id,
+                    },
+                )
+
+        deliveries = 0
+        for user_id, channel, _publish in members:
+            while True:
+                try:
+                    await asyncio.wait_for(layer.receive(channel), timeout=0.001)
+                except asyncio.TimeoutError:
+                    break
+                deliveries += 1
+        return deliveries, time.perf_counter() - started
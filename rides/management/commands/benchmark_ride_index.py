@@ -0,0 +1,128 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from rides.management.seeding import (DEFAULT_CENTER, random_point, seed_rides,
+                                      seed_users)
+from rides.serializers import RideSearchSerializer
+from rides.spatial_index import PendingRideIndex, haversine_m
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the in-process ride index with the PostGIS search: checks that "
+        "both return the same rides and times each path. Seeded rows are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=20000)
+        parser.add_argument("--drivers", type=int, default=2000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--radius", type=float, default=3000.0)
+        parser.add_argument(
+            "--live",
+            action="store_true",
+            help="Check against the existing rides instead of seeding",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if not options["live"]:
+                    drivers = seed_users(options["drivers"], prefix="index-driver")
+                    seed_rides(options["rides"], drivers)
+                report = self.run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+        for line in report["lines"]:
+            self.stdout.write(line)
+        if report["mismatches"]:
+            raise CommandError(f"{report['mismatches']} queries disagreed with PostGIS")
+        self.stdout.write(self.style.SUCCESS("Index and PostGIS results agree"))
+
+    def run(self, options):
+        rng = random.Random(1)
+        started = time.perf_counter()
+        index = PendingRideIndex()
+        index.load()
+        load_ms = (time.perf_counter() - started) * 1000
+
+        sql_times, index_times = [], []
+        mismatches = boundary = 0
+        for _ in range(options["queries"]):
+            pickup = random_point(DEFAULT_CENTER, rng=rng)
+            destination = random_point(DEFAULT_CENTER, rng=rng)
+            serializer = RideSearchSerializer(
+                data={
+                    "pickup_point": {"type": "Point", "coordinates": list(pickup.coords)},
+                    "destination_point": {
+                        "type": "Point",
+                        "coordinates": list(destination.coords),
+                    },
+                    "seats_needed": rng.randint(1, 3),
+                    "radius": options["radius"],
+                }
+            )
+            serializer.is_valid(raise_exception=True)
+            data = serializer.validated_data
+
+            started = time.perf_counter()
+            expected = set(serializer.get_available_rides().values_list("id", flat=True))
+            sql_times.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            actual = {
+                key[-1]
+                for key in index.search(
+                    pickup.coords, destination.coords, data["seats_needed"], data["radius"]
+                )
+            }
+            index_times.append((time.perf_counter() - started) * 1000)
+
+            if expected != actual:
+                if self.only_boundary_differences(index, expected, actual, pickup, destination, data["radius"]):
+                    boundary += 1
+                else:
+                    mismatches += 1
+
+        return {
+            "mismatches": mismatches,
+            "lines": [
+                f"Indexed rides: {len(index)} (loaded in {load_ms:.1f} ms)",
+                f"Queries: {options['queries']}, mismatches: {mismatches}, "
+                f"spheroid/sphere boundary differences: {boundary}",
+                self.timing_line("PostGIS", sql_times),
+                self.timing_line("Index", index_times),
+            ],
+        }
+
+    def only_boundary_differences(self, index, expected, actual, pickup, destination, radius):
+        """PostGIS measures on the spheroid, the index on a sphere; allow 0.5%."""
+        for ride_id in expected ^ actual:
+            ride = index.get(ride_id)
+            if ride is None:
+                return False
+            furthest = max(
+                haversine_m(ride.start, pickup.coords),
+                haversine_m(ride.end, destination.coords),
+            )
+            if abs(furthest - radius) > radius * 0.005:
+                return False
+        return True
+
+    def timing_line(self, label, samples):
+        samples = sorted(samples)
+        p95 = samples[int(len(samples) * 0.95) - 1] if samples else 0
+        return (
+            f"{label}: mean {statistics.mean(samples):.3f} ms, "
+            f"p50 {statistics.median(samples):.3f} ms, p95 {p95:.3f} ms"
+        )
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from channels.routing import URLRouter
+from channels.testing.websocket import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from authentication.models import User
+from rides import access
+from rides.management.seeding import seed_rides, seed_users
+from rides.middleware import TokenAuthMiddleware
+from rides.models import PassengerRideRequest
+from voy.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent WebSocket handshakes per second with every consumer "
+        "database call on the shared thread-sensitive thread versus the "
+        "bounded database pool. Each run uses fresh tokens and cold access "
+        "caches, so every handshake loads its principal and checks access. "
+        "Seeded users and rides are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=50)
+        parser.add_argument("--passengers", type=int, default=3, help="Per ride")
+        parser.add_argument("--threads", type=int, default=8, help="Size of the database pool")
+
+    def handle(self, *args, **options):
+        drivers = seed_users(options["rides"], prefix="connect-bench-driver")
+        passengers = seed_users(
+            options["rides"] * options["passengers"], prefix="connect-bench-passenger"
+        )
+        users = drivers + passengers
+        try:
+            rides = seed_rides(options["rides"], drivers)
+            PassengerRideRequest.objects.bulk_create(
+                PassengerRideRequest(
+                    passenger=passenger,
+                    ride=rides[index // options["passengers"]],
+                    pickup_location="Benchmark pickup",
+                    dropoff_location="Benchmark drop-off",
+                    status="CONFIRMED",
+                )
+                for index, passenger in enumerate(passengers)
+            )
+            members = [
+                (ride.id, user)
+                for index, ride in enumerate(rides)
+                for user in [
+                    ride.driver,
+                    *passengers[index * options["passengers"]:(index + 1) * options["passengers"]],
+                ]
+            ]
+
+            baseline = None
+            for label, threads in (("thread-sensitive", 0), ("db pool", options["threads"])):
+                with override_settings(
+                    RIDE_WS_DB_THREADS=threads,
+                    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+                ):
+                    for ride in rides:
+                        access.invalidate(ride.id)
+                    # New jtis, so no principal is cached yet
+                    sockets = [
+                        (ride_id, str(AccessToken.for_user(user))) for ride_id, user in members
+                    ]
+                    elapsed = asyncio.run(self.run(sockets))
+                rate = len(sockets) / elapsed
+                baseline = baseline or rate
+                self.stdout.write(
+                    f"{label}: {len(sockets)} handshakes in {elapsed:.2f}s "
+                    f"({rate:,.0f}/sec, {rate / baseline:.2f}x)"
+                )
+        finally:
+            # Cascades to the rides and requests
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    async def run(self, sockets):
+        application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+        communicators = [
+            WebsocketCommunicator(application, f"/ws/rides/{ride_id}/location/?token={token}")
+            for ride_id, token in sockets
+        ]
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(socket.connect() for socket in communicators))
+        elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*(socket.disconnect() for socket in communicators))
+        refused = sum(1 for connected, _ in results if not connected)
+        if refused:
+            raise RuntimeError(f"{refused} benchmark sockets were refused")
+        return elapsed
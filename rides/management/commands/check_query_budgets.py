@@ -0,0 +1,155 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from rides.management.seeding import (DEFAULT_CENTER, random_point, seed_rides,
+                                      seed_users)
+from rides.models import ChatMessage, PassengerRideRequest, RideDetails
+
+# Maximum queries per request, independent of how many rows are returned
+QUERY_BUDGETS = {
+    "passenger-search-rides": 2,
+    "passenger-batch-search-rides": 2,
+    "driver-list-requests": 2,
+    # Cold read: builds the ride snapshot; warm reads make no queries
+    "ride-status-details": 3,
+    "ride-history": 4,
+    "chat-history": 1,
+}
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Hit the rides endpoints on a small and a large seeded dataset and fail "
+        "if any of them exceeds its query budget or scales with result size. "
+        "All seeded rows are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--small", type=int, default=2)
+        parser.add_argument("--large", type=int, default=25)
+
+    def handle(self, *args, **options):
+        counts = {}
+        for size in (options["small"], options["large"]):
+            try:
+                with transaction.atomic():
+                    counts[size] = self.measure(size)
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+        failures = []
+        for name, budget in QUERY_BUDGETS.items():
+            small, large = counts[options["small"]][name], counts[options["large"]][name]
+            line = f"{name}: {small} queries (small), {large} queries (large), budget {budget}"
+            if large > budget or small != large:
+                failures.append(line)
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+
+        if failures:
+            raise CommandError(f"{len(failures)} endpoint(s) exceeded their query budget")
+        self.stdout.write(self.style.SUCCESS("All rides endpoints are within budget"))
+
+    def seed(self, size):
+        driver, *passengers = seed_users(size + 1, prefix=f"budget-{size}")
+        drivers = seed_users(size, prefix=f"budget-drivers-{size}")
+        seed_rides(size * 4, drivers, spread=0.005)
+
+        now = timezone.now()
+        active_ride, *finished_rides = [
+            RideDetails(
+                driver=driver,
+                start_location="Budget start",
+                end_location="Budget end",
+                start_point=random_point(spread=0.005),
+                end_point=random_point(spread=0.005),
+                start_time=now + timedelta(hours=1),
+                available_seats=8,
+                status="PENDING" if index == 0 else "COMPLETED",
+            )
+            for index in range(size + 1)
+        ]
+        for ride in [active_ride, *finished_rides]:
+            ride.sync_geography_fields()
+        RideDetails.objects.bulk_create([active_ride, *finished_rides])
+
+        requests = []
+        for passenger in passengers:
+            for ride, status in [(active_ride, "CONFIRMED"), (active_ride, "PENDING")] + [
+                (ride, "COMPLETED") for ride in finished_rides
+            ]:
+                requests.append(
+                    PassengerRideRequest(
+                        passenger=passenger,
+                        ride=ride,
+                        pickup_location="Budget pickup",
+                        dropoff_location="Budget drop-off",
+                        status=status,
+                    )
+                )
+        PassengerRideRequest.objects.bulk_create(requests)
+
+        partner = passengers[0]
+        ChatMessage.objects.bulk_create(
+            ChatMessage(
+                ride=active_ride,
+                sender=driver if index % 2 else partner,
+                receiver=partner if index % 2 else driver,
+                message=f"Budget message {index}",
+                timestamp=now + timedelta(seconds=index),
+            )
+            for index in range(size * 10)
+        )
+        return driver, active_ride, partner
+
+    def measure(self, size):
+        driver, active_ride, partner = self.seed(size)
+        client = APIClient()
+        client.force_authenticate(driver)
+
+        search = {
+            "pickup_point": {"type": "Point", "coordinates": list(DEFAULT_CENTER)},
+            "destination_point": {"type": "Point", "coordinates": list(DEFAULT_CENTER)},
+            "radius": 5000,
+        }
+        calls = {
+            "passenger-search-rides": lambda: client.post(
+                reverse("passenger-search-rides"), search, format="json"
+            ),
+            "passenger-batch-search-rides": lambda: client.post(
+                reverse("passenger-batch-search-rides"),
+                {"queries": [search, search]},
+                format="json",
+            ),
+            "driver-list-requests": lambda: client.get(
+                reverse("driver-list-requests", args=[active_ride.id])
+            ),
+            "ride-status-details": lambda: client.get(
+                reverse("ride-status-details", args=[active_ride.id])
+            ),
+            "ride-history": lambda: client.get(reverse("ride-history")),
+            "chat-history": lambda: client.get(
+                reverse("chat-history", args=[active_ride.id, partner.id])
+            ),
+        }
+
+        counts = {}
+        for name, call in calls.items():
+            with CaptureQueriesContext(connection) as queries:
+                response = call()
+            if response.status_code >= 400:
+                raise CommandError(f"{name} returned HTTP {response.status_code}")
+            counts[name] = len(queries)
+        return counts
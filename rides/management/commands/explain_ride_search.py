@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from rides.management.seeding import (DEFAULT_CENTER, random_point, seed_rides,
+                                      seed_users)
+from rides.models import RideDetails
+from rides.serializers import RideSearchSerializer
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN the ride search query on a seeded dataset and fail unless the "
+        "geography GiST indexes are used. All seeded rows are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=50000)
+        parser.add_argument("--drivers", type=int, default=500)
+        parser.add_argument("--radius", type=float, default=2000.0)
+        parser.add_argument(
+            "--mode",
+            choices=[RideSearchSerializer.MODE_ENDPOINTS, RideSearchSerializer.MODE_CORRIDOR],
+            default=RideSearchSerializer.MODE_ENDPOINTS,
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                plan = self.explain(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+        self.stdout.write(plan)
+        if not self.uses_geography_index(plan):
+            raise CommandError("Ride search did not use a geography GiST index")
+        self.stdout.write(self.style.SUCCESS("Ride search uses a geography GiST index"))
+
+    def explain(self, options):
+        drivers = seed_users(options["drivers"], prefix="explain-driver")
+        seed_rides(options["rides"], drivers)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {RideDetails._meta.db_table}")
+
+        serializer = RideSearchSerializer(
+            data={
+                "pickup_point": {"type": "Point", "coordinates": list(DEFAULT_CENTER)},
+                "destination_point": {
+                    "type": "Point",
+                    "coordinates": list(random_point().coords),
+                },
+                "radius": options["radius"],
+                "mode": options["mode"],
+            }
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.get_available_rides().explain(analyze=True)
+
+    def uses_geography_index(self, plan):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = %s AND indexdef ILIKE %s",
+                [RideDetails._meta.db_table, "%gist%_geography%"],
+            )
+            index_names = [row[0] for row in cursor.fetchall()]
+        return any(
+            "Index Scan" in line and any(name in line for name in index_names)
+            for line in plan.splitlines()
+        )
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import os
+import resource
+import time
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing.websocket import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from authentication.models import User
+from rides import access, snapshots
+from rides.management.seeding import seed_rides, seed_users
+from rides.middleware import UserPrincipal, load_principal_fields
+from rides.models import PassengerRideRequest
+from voy.routing import websocket_urlpatterns
+
+LAYERS = {
+    "memory": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "redis": None,  # the project's CHANNEL_LAYERS["default"]
+}
+
+
+def rss_kb():
+    """Current resident set size of this process in KiB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        # Peak rather than current, but the best portable number
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 3)
+
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(samples[-1], 3)}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the ride WebSocket consumers in this process: N rides x M "
+        "passengers streaming locations (and optionally chatting) through "
+        "WebsocketCommunicator. Prints end-to-end latency percentiles, messages "
+        "per second and RSS per connection as JSON, with the consumers' database "
+        "and cache calls on the shared sync thread and on the bounded pool. "
+        "Seeded users and rides are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rides", type=int, default=20)
+        parser.add_argument("--passengers", type=int, default=4, help="Per ride")
+        parser.add_argument("--rate", type=float, default=1.0, help="GPS updates per second per rider")
+        parser.add_argument("--chat-rate", type=float, default=0.0, help="Chat messages per second per passenger")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic")
+        parser.add_argument("--layer", choices=["memory", "redis", "both"], default="both")
+        parser.add_argument(
+            "--throttle",
+            action="store_true",
+            help="Keep the server's location throttle (frames may be coalesced)",
+        )
+        parser.add_argument(
+            "--db-threads",
+            type=int,
+            nargs="+",
+            default=[0, settings.RIDE_WS_DB_THREADS],
+            help="RIDE_WS_DB_THREADS values to run (0 is the shared sync thread)",
+        )
+        parser.add_argument("--output", help="Also write the JSON report to this file")
+
+    def handle(self, *args, **options):
+        rides = self.seed(options["rides"], options["passengers"])
+        try:
+            principals = self.prime(rides)
+            layers = ["memory", "redis"] if options["layer"] == "both" else [options["layer"]]
+            results = []
+            for layer in layers:
+                for threads in options["db_threads"]:
+                    overrides = {"RIDE_WS_DB_THREADS": threads}
+                    if LAYERS[layer] is not None:
+                        overrides["CHANNEL_LAYERS"] = {"default": LAYERS[layer]}
+                    if not options["throttle"]:
+                        overrides["RIDE_LOCATION_MIN_INTERVAL"] = 0.0
+                        overrides["RIDE_LOCATION_MIN_DISPLACEMENT"] = 0.0
+                    with override_settings(**overrides):
+                        results.append({
+                            "layer": layer,
+                            "db_threads": threads,
+                            **asyncio.run(self.run(rides, principals, options)),
+                        })
+        finally:
+            # Cascades to the rides, requests, trails and messages
+            User.objects.filter(
+                id__in=[user_id for ride in rides for user_id in ride["members"]]
+            ).delete()
+
+        report = {
+            "config": {
+                key: options[key]
+                for key in ("rides", "passengers", "rate", "chat_rate", "duration", "throttle")
+            },
+            "results": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output)
+        self.stdout.write(output)
+
+    def seed(self, ride_count, passenger_count):
+        drivers = seed_users(ride_count, prefix="loadtest-driver")
+        passengers = seed_users(ride_count * passenger_count, prefix="loadtest-passenger")
+        rides = seed_rides(ride_count, drivers)
+        requests = []
+        seeded = []
+        for index, ride in enumerate(rides):
+            riders = passengers[index * passenger_count:(index + 1) * passenger_count]
+            requests.extend(
+                PassengerRideRequest(
+                    passenger=passenger,
+                    ride=ride,
+                    pickup_location="Load test pickup",
+                    dropoff_location="Load test drop-off",
+                    status="CONFIRMED",
+                )
+                for passenger in riders
+            )
+            seeded.append({
+                "id": ride.id,
+                "driver": ride.driver_id,
+                "passengers": [passenger.id for passenger in riders],
+                "members": [ride.driver_id, *[passenger.id for passenger in riders]],
+            })
+        PassengerRideRequest.objects.bulk_create(requests)
+        return seeded
+
+    def prime(self, rides):
+        """Warm the caches a real worker would have warm: access, snapshots, principals."""
+        principals = {}
+        for ride in rides:
+            snapshots.build_snapshot(ride["id"])
+            for user_id in ride["members"]:
+                access.get_location_access(ride["id"], user_id)
+                principals[user_id] = UserPrincipal(load_principal_fields.__wrapped__(user_id))
+            for passenger_id in ride["passengers"]:
+                access.get_chat_access(ride["id"], ride["driver"], passenger_id)
+                access.get_chat_access(ride["id"], passenger_id, ride["driver"])
+        return principals
+
+    async def run(self, rides, principals, options):
+        application = URLRouter(websocket_urlpatterns)
+        sent_at = {}
+        latencies = {"location": [], "chat": []}
+        delivered = {"location": 0, "chat": 0}
+        sent = {"location": 0, "chat": 0}
+
+        def communicator(path, user_id):
+            socket = WebsocketCommunicator(application, path)
+            socket.scope["user"] = principals[user_id]
+            return socket
+
+        async def listen(socket):
+            while True:
+                output = await socket.receive_output(timeout=3600)
+                if output["type"] != "websocket.send" or not output.get("text"):
+                    continue
+                frame = json.loads(output["text"])
+                if "latitude" in frame:
+                    kind, key = "location", (frame["user_id"], frame["latitude"])
+                elif "message" in frame and frame.get("message_id"):
+                    kind, key = "chat", frame["message"]
+                else:
+                    continue
+                started = sent_at.get(key)
+                if started is not None:
+                    delivered[kind] += 1
+                    latencies[kind].append((time.perf_counter() - started) * 1000)
+
+        # Connect everything first so RSS and traffic are measured separately
+        rss_before = rss_kb()
+        sockets = []
+        for ride in rides:
+            for user_id in ride["members"]:
+                sockets.append(
+                    (communicator(f"/ws/rides/{ride['id']}/location/", user_id), "location", ride, user_id)
+                )
+            if options["chat_rate"] > 0:
+                for passenger_id in ride["passengers"]:
+                    for user_id, partner_id in (
+                        (passenger_id, ride["driver"]),
+                        (ride["driver"], passenger_id),
+                    ):
+                        sockets.append((
+                            communicator(f"/ws/ride-chat/{ride['id']}/{partner_id}/", user_id),
+                            "chat",
+                            ride,
+                            user_id,
+                        ))
+
+        connect_started = time.perf_counter()
+        for socket, *_ in sockets:
+            connected, _ = await socket.connect()
+            if not connected:
+                raise RuntimeError("A load test socket was refused")
+        connect_seconds = time.perf_counter() - connect_started
+        listeners = [asyncio.ensure_future(listen(socket)) for socket, *_ in sockets]
+        rss_connected = rss_kb()
+
+        async def stream_locations(socket, user_id, index):
+            interval = 1 / options["rate"]
+            sequence = 0
+            while time.perf_counter() < deadline:
+                sequence += 1
+                # A unique latitude per frame identifies it on the receiving side
+                latitude = round(28.0 + index * 0.001 + sequence * 1e-6, 6)
+                sent_at[(user_id, latitude)] = time.perf_counter()
+                sent["location"] += 1
+                await socket.send_json_to({"latitude": latitude, "longitude": 77.2})
+                await asyncio.sleep(interval)
+
+        async def stream_chat(socket, user_id):
+            interval = 1 / options["chat_rate"]
+            sequence = 0
+            while time.perf_counter() < deadline:
+                sequence += 1
+                message = f"loadtest {user_id} {sequence}"
+                sent_at[message] = time.perf_counter()
+                sent["chat"] += 1
+                # A client id makes the consumer claim it, like a real client's
+                await socket.send_json_to({"message": message, "message_id": str(uuid.uuid4())})
+                await asyncio.sleep(interval)
+
+        deadline = time.perf_counter() + options["duration"]
+        traffic_started = time.perf_counter()
+        senders = []
+        for index, (socket, kind, ride, user_id) in enumerate(sockets):
+            if kind == "location":
+                senders.append(stream_locations(socket, user_id, index))
+            elif user_id != ride["driver"]:
+                senders.append(stream_chat(socket, user_id))
+        await asyncio.gather(*senders)
+        # Let in-flight frames arrive
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - traffic_started
+
+        for listener in listeners:
+            listener.cancel()
+        for socket, *_ in sockets:
+            await socket.disconnect()
+
+        connections = len(sockets)
+        return {
+            "connections": connections,
+            "connects_per_sec": round(connections / connect_seconds, 1),
+            "rss_per_connection_kb": round((rss_connected - rss_before) / connections, 1),
+            "rss_kb": rss_kb(),
+            "location": {
+                "sent": sent["location"],
+                "delivered": delivered["location"],
+                "msgs_per_sec": round(delivered["location"] / elapsed, 1),
+                "latency_ms": percentiles(latencies["location"]),
+            },
+            "chat": {
+                "sent": sent["chat"],
+                "delivered": delivered["chat"],
+                "msgs_per_sec": round(delivered["chat"] / elapsed, 1),
+                "latency_ms": percentiles(latencies["chat"]),
+            },
+        }
@@ -0,0 +1,69 @@
+"""
+Synthetic data helpers for the rides management commands.
+
+Everything here is meant to run inside a transaction that the calling command
+rolls back, so nothing it creates outlives the command.
+"""
+import random
+import zlib
+from datetime import timedelta
+
+from django.contrib.gis.geos import LineString, Point
+from django.utils import timezone
+
+from authentication.models import User
+from rides.models import RideDetails
+
+# Roughly a 20 km box around the default search centre
+DEFAULT_CENTER = (77.2090, 28.6139)
+DEFAULT_SPREAD = 0.1
+
+
+def seed_users(count, prefix="seed"):
+    # Phone numbers are unique per verified user, so namespace them by prefix
+    phone_prefix = zlib.crc32(prefix.encode()) % 10000
+    users = [
+        User(
+            email=f"{prefix}-{index}@seed.invalid",
+            phone_number=f"9{phone_prefix:04d}{index:07d}",
+            first_name=prefix.title(),
+            last_name=str(index),
+            is_active=True,
+            registration_pending=False,
+            email_verified=True,
+            phone_verified=True,
+        )
+        for index in range(count)
+    ]
+    return User.objects.bulk_create(users)
+
+
+def random_point(center=DEFAULT_CENTER, spread=DEFAULT_SPREAD, rng=random):
+    return Point(
+        center[0] + rng.uniform(-spread, spread),
+        center[1] + rng.uniform(-spread, spread),
+        srid=4326,
+    )
+
+
+def seed_rides(count, drivers, center=DEFAULT_CENTER, spread=DEFAULT_SPREAD, seed=0):
+    """Bulk-create `count` future PENDING rides spread around `center`."""
+    rng = random.Random(seed)
+    now = timezone.now()
+    rides = []
+    for index in range(count):
+        start = random_point(center, spread, rng)
+        end = random_point(center, spread, rng)
+        ride = RideDetails(
+            driver=drivers[index % len(drivers)],
+            start_location=f"Seed start {index}",
+            end_location=f"Seed end {index}",
+            start_point=start,
+            end_point=end,
+            route_line=LineString(start, end, srid=4326),
+            start_time=now + timedelta(minutes=rng.randint(10, 60 * 24)),
+            available_seats=rng.randint(1, 4),
+        )
+        ride.sync_geography_fields()
+        rides.append(ride)
+    return RideDetails.objects.bulk_create(rides, batch_size=1000)
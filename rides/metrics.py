@@ -0,0 +1,52 @@
+"""
+In-process counters and gauges for the WebSocket consumers.
+
+These are updated on the hot path, so they stay in memory rather than going
+through the cache like the search cache counters. Each ASGI worker reports
+its own numbers (see RideMetricsView).
+"""
+import os
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_peaks = {}
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def gauge_add(name, amount):
+    """Move a gauge (e.g. total queued frames) and track its peak."""
+    with _lock:
+        value = _gauges[name] = _gauges.get(name, 0) + amount
+        if value > _peaks.get(name, 0):
+            _peaks[name] = value
+
+
+def peak(name, value):
+    """Record `value` if it is the highest seen for `name`."""
+    with _lock:
+        if value > _peaks.get(name, 0):
+            _peaks[name] = value
+
+
+def snapshot():
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "peaks": dict(_peaks),
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _peaks.clear()
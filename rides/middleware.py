@@ -1,48 +1,137 @@
-from channels.db import database_sync_to_async
+from urllib.parse import parse_qs
+
 from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken
 
+from rides import ws_cache
+from rides.db_executor import db_sync_to_async
+
 # getting the user custom model used
 User = get_user_model()
 
+# Browsers can't set headers on a WebSocket: they offer ["voy.auth", "bearer.<token>"]
+# as subprotocols instead, and the consumer answers with AUTH_SUBPROTOCOL
+AUTH_SUBPROTOCOL = "voy.auth"
+TOKEN_SUBPROTOCOL_PREFIX = "bearer."
+
+PRINCIPAL_FIELDS = (
+    "id",
+    "email",
+    "is_active",
+    "is_staff",
+    "is_driver",
+    "is_driver_verified",
+    "current_role",
+)
+
+
+class UserPrincipal:
+    """
+    The authenticated user of a WebSocket, built from cached fields instead
+    of a model instance. Anything else is read from the real User, which is
+    loaded on first use; that is a query, so only touch it from sync code
+    (e.g. inside db_sync_to_async).
+    """
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self.pk = self.id
+        self._user = None
+
+    def get_user(self):
+        if self._user is None:
+            self._user = User.objects.get(id=self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __eq__(self, other):
+        return isinstance(other, (UserPrincipal, User)) and other.pk == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return self.email
+
+
+def principal_cache_key(jti):
+    return f"rides:ws_principal:{jti}"
 
-@database_sync_to_async
-def get_user_from_token(token):
+
+@db_sync_to_async
+def load_principal_fields(user_id):
+    return User.objects.filter(id=user_id).values(*PRINCIPAL_FIELDS).first()
+
+
+async def get_user_from_token(token):
+    """
+    Verify the token's signature and expiry, then resolve the user from the
+    principal cache (keyed by the token's jti). Only a cache miss touches
+    the database.
+    """
     try:
-        # Add print statements for debugging
-        print(f"Received Token: {token}")
         access_token = AccessToken(token)
-        print(f"Decoded Token User ID: {access_token['user_id']}")
-        
-        user = User.objects.get(id=access_token["user_id"])
-        print(f"Authenticated User: {user.email}")
-        return user
-    except Exception as e:
-        print(f"Token Authentication Error: {e}")
+        user_id = access_token[api_settings.USER_ID_CLAIM]
+        jti = access_token[api_settings.JTI_CLAIM]
+    except (TokenError, KeyError):
         return AnonymousUser()
 
+    key = principal_cache_key(jti)
+    fields = await ws_cache.aget(key)
+    if fields is None:
+        fields = await load_principal_fields(user_id)
+        if fields is None:
+            return AnonymousUser()
+        await ws_cache.aset(key, fields, timeout=settings.RIDE_WS_PRINCIPAL_TTL)
+
+    if not fields["is_active"]:
+        return AnonymousUser()
+    return UserPrincipal(fields)
+
+
+def get_token(scope):
+    """The raw token from the Authorization header, ?token= or a subprotocol."""
+    headers = dict(scope["headers"])
+    if b"authorization" in headers:
+        try:
+            token_name, token_key = headers[b"authorization"].decode().split()
+        except ValueError:
+            return None
+        return token_key if token_name.lower() == "bearer" else None
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("token"):
+        return query["token"][0]
+
+    for subprotocol in scope.get("subprotocols", []):
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    return None
+
+
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
-        headers = dict(scope["headers"])
-        
-        # Add debug print statements
-        print("WebSocket Connection Attempt")
-        print(f"Available Headers: {headers}")
-
-        if b"authorization" in headers:
-            try:
-                token_name, token_key = headers[b"authorization"].decode().split()
-                print(f"Token Name: {token_name}, Token Key: {token_key}")
-                
-                if token_name.lower() == "bearer":
-                    scope["user"] = await get_user_from_token(token_key)
-            except Exception as e:
-                print(f"Middleware Authentication Error: {e}")
-                scope["user"] = AnonymousUser()
-        else:
-            print("No Authorization Header Found")
-            scope["user"] = AnonymousUser()
-        
-        return await super().__call__(scope, receive, send)
\ No newline at end of file
+        token = get_token(scope)
+
+        scope = dict(scope)
+        # The token is never echoed back as the accepted subprotocol
+        scope["subprotocols"] = [
+            subprotocol
+            for subprotocol in scope.get("subprotocols", [])
+            if not subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX)
+        ]
+        scope["user"] = await get_user_from_token(token) if token else AnonymousUser()
+
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:12
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0003_alter_ridedetails_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ridedetails',
+            name='route_geography',
+            field=django.contrib.gis.db.models.fields.LineStringField(blank=True, editable=False, geography=True, null=True, srid=4326),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE rides_ridedetails SET route_geography = route_line::geography WHERE route_line IS NOT NULL;",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:03
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0004_ridedetails_route_geography'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ridedetails',
+            name='start_geography',
+            field=django.contrib.gis.db.models.fields.PointField(blank=True, editable=False, geography=True, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='ridedetails',
+            name='end_geography',
+            field=django.contrib.gis.db.models.fields.PointField(blank=True, editable=False, geography=True, null=True, srid=4326),
+        ),
+        migrations.RunSQL(
+            sql=(
+                "UPDATE rides_ridedetails "
+                "SET start_geography = start_point::geography, end_geography = end_point::geography "
+                "WHERE start_point IS NOT NULL OR end_point IS NOT NULL;"
+            ),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:41
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_ridedetails_start_end_geography'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationTrailPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField()),
+                ('point', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trail_points', to='rides.ridedetails')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trail_points', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['recorded_at'],
+                'indexes': [models.Index(fields=['ride', 'user', 'recorded_at'], name='rides_locat_ride_id_d57c9e_idx')],
+            },
+        ),
+    ]
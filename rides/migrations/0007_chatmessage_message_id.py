@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:20
+
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def populate_message_ids(apps, schema_editor):
+    ChatMessage = apps.get_model('rides', 'ChatMessage')
+    messages = list(ChatMessage.objects.filter(message_id__isnull=True).only('id'))
+    for message in messages:
+        message.message_id = uuid.uuid4()
+    ChatMessage.objects.bulk_update(messages, ['message_id'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0006_locationtrailpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='message_id',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_message_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='message_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:52
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0007_chatmessage_message_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(models.F('ride'), django.db.models.functions.comparison.Least('sender', 'receiver'), django.db.models.functions.comparison.Greatest('sender', 'receiver'), models.F('timestamp'), models.F('id'), name='rides_chat_pair_timeline_idx'),
+        ),
+    ]
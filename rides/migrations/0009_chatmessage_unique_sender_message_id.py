@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 21:40
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0008_chatmessage_rides_chat_pair_timeline_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='message_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('message_id', 'sender'), name='unique_sender_message_id'),
+        ),
+    ]
@@ -1,5 +1,9 @@
+import uuid
+
 from django.contrib.gis.db import models
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
 
 from authentication.models import User
 
@@ -20,6 +24,17 @@ class RideDetails(models.Model):
     start_point = models.PointField(srid=4326, null=True, blank=True)
     end_point = models.PointField(srid=4326, null=True, blank=True)
     route_line = models.LineStringField(srid=4326, null=True, blank=True)
+    # Geography copies of the fields above, kept in sync by save(). Their GiST
+    # indexes back the metre-based dwithin lookups used by ride search.
+    start_geography = models.PointField(
+        geography=True, srid=4326, null=True, blank=True, editable=False
+    )
+    end_geography = models.PointField(
+        geography=True, srid=4326, null=True, blank=True, editable=False
+    )
+    route_geography = models.LineStringField(
+        geography=True, srid=4326, null=True, blank=True, editable=False
+    )
     start_time = models.DateTimeField()
     available_seats = models.PositiveIntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(8)]
@@ -30,8 +45,52 @@ class RideDetails(models.Model):
     def __str__(self):
         return f"Ride from {self.start_location} to {self.end_location} by {self.driver.email} on {self.start_time.strftime('%Y-%m-%d %H:%M')}"
 
+    # Geometry fields mirrored into geography columns on every save.
+    GEOGRAPHY_FIELDS = {
+        "start_point": "start_geography",
+        "end_point": "end_geography",
+        "route_line": "route_geography",
+    }
+
+    def sync_geography_fields(self):
+        """Copy the geometry fields into their geography columns (bulk_create skips save())."""
+        for geometry_field, geography_field in self.GEOGRAPHY_FIELDS.items():
+            setattr(self, geography_field, getattr(self, geometry_field))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what was loaded so signal handlers can tell what changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def loaded_value(self, field_name):
+        return getattr(self, "_loaded_values", {}).get(field_name)
+
+    def changed_fields(self, field_names):
+        loaded = getattr(self, "_loaded_values", {})
+        return {
+            name
+            for name in field_names
+            if name not in loaded or loaded[name] != getattr(self, name)
+        }
+
     def save(self, *args, **kwargs):
+        self.sync_geography_fields()
+
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = set(update_fields) | {
+                geography_field
+                for geometry_field, geography_field in self.GEOGRAPHY_FIELDS.items()
+                if geometry_field in update_fields
+            }
         super().save(*args, **kwargs)
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+        }
 
     def calculate_distance(self):
         if self.start_point and self.end_point:
@@ -86,6 +145,25 @@ class PassengerRideRequest(models.Model):
         ]
 
 
+class LocationTrailPoint(models.Model):
+    """A downsampled point of a rider's location stream, written in batches (see rides.trails)."""
+
+    ride = models.ForeignKey(
+        RideDetails, on_delete=models.CASCADE, related_name="trail_points"
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="trail_points"
+    )
+    recorded_at = models.DateTimeField()
+    point = models.PointField(srid=4326)
+
+    class Meta:
+        ordering = ["recorded_at"]
+        indexes = [
+            models.Index(fields=["ride", "user", "recorded_at"]),
+        ]
+
+
 class Rating(models.Model):
     ride = models.ForeignKey("RideDetails", on_delete=models.CASCADE)
     from_user = models.ForeignKey(
@@ -109,10 +187,31 @@ class ChatMessage(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Assigned when the message is broadcast (or by the sending client); rows
+    # are written later in batches. Unique per sender, not globally.
+    message_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"Message from {self.sender.email} to {self.receiver.email} - {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
     
     class Meta:
-        ordering = ['timestamp']
\ No newline at end of file
+        ordering = ['timestamp']
+        indexes = [
+            # One conversation in time order, whichever side sent each message
+            models.Index(
+                'ride',
+                Least('sender', 'receiver'),
+                Greatest('sender', 'receiver'),
+                'timestamp',
+                'id',
+                name='rides_chat_pair_timeline_idx',
+            ),
+        ]
+        constraints = [
+            # message_id first, so it also serves lookups by message_id alone
+            models.UniqueConstraint(
+                fields=['message_id', 'sender'],
+                name='unique_sender_message_id',
+            ),
+        ]
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Bounded per-connection outbound queue for the ride WebSocket consumers.
+
+Frames are handed to an OutboundQueue instead of being awaited on send()
+directly; a single sender task per connection drains it. The queue holds two
+kinds of frames:
+
+* droppable frames (locations) are keyed, and a newer frame for the same key
+  replaces the queued one, so at most one frame per sender is ever waiting;
+* ordered frames (chat, control) are delivered in order and never dropped.
+
+Every frame counts towards the connection's limits: more than `max_ordered`
+ordered frames, or more than `max_bytes` of queued payload of either kind,
+means the client can't keep up, and `on_overflow` is called (the consumers
+close the socket).
+
+What this does and doesn't bound: it caps what the application holds per
+connection. ASGI gives no signal for when a frame has actually been written
+to the network, and daphne's send() returns as soon as Twisted has buffered
+the frame, so bytes already handed to the server sit in its transport
+buffer outside this limit. With daphne the queue only fills while the
+sender task can't get to the event loop; a phone that stops reading is
+bounded here only to the extent the server's own buffers are.
+"""
+import asyncio
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from rides import metrics
+
+QUEUE_DEPTH = "ws_outbound_queued"
+
+
+def frame_size(frame):
+    """Payload length of a frame (characters for text frames)."""
+    if frame.get("bytes_data") is not None:
+        return len(frame["bytes_data"])
+    return len(frame.get("text_data") or "")
+
+
+class OutboundQueue:
+    def __init__(self, send, on_overflow, max_ordered=None, max_bytes=None):
+        self.send = send
+        self.on_overflow = on_overflow
+        self.max_ordered = (
+            settings.RIDE_WS_MAX_QUEUED_FRAMES if max_ordered is None else max_ordered
+        )
+        self.max_bytes = (
+            settings.RIDE_WS_MAX_QUEUED_BYTES if max_bytes is None else max_bytes
+        )
+        self._ordered = deque()
+        self._latest = OrderedDict()
+        self._bytes = 0
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.ensure_future(self._run())
+
+    def __len__(self):
+        return len(self._ordered) + len(self._latest)
+
+    def put(self, **frame):
+        """Queue a frame that must be delivered, in order."""
+        if self._closed:
+            return
+        size = frame_size(frame)
+        if len(self._ordered) >= self.max_ordered or self._bytes + size > self.max_bytes:
+            self._overflow()
+            return
+        self._ordered.append(frame)
+        self._bytes += size
+        self._queued(1)
+
+    def put_latest(self, key, **frame):
+        """Queue a frame that supersedes any queued frame with the same key."""
+        if self._closed:
+            return
+        size = frame_size(frame)
+        replaced = self._latest.get(key)
+        freed = frame_size(replaced) if replaced is not None else 0
+        if self._bytes - freed + size > self.max_bytes:
+            self._overflow()
+            return
+        self._latest.pop(key, None)
+        self._latest[key] = frame
+        self._bytes += size - freed
+        if replaced is not None:
+            metrics.incr("ws_outbound_dropped")
+        else:
+            self._queued(1)
+
+    def _overflow(self):
+        metrics.incr("ws_outbound_overflows")
+        self.close()
+        asyncio.ensure_future(self.on_overflow())
+
+    def _queued(self, count):
+        metrics.gauge_add(QUEUE_DEPTH, count)
+        metrics.peak("ws_outbound_connection_depth", len(self))
+        metrics.peak("ws_outbound_connection_bytes", self._bytes)
+        self._wakeup.set()
+
+    def _next(self):
+        if self._ordered:
+            frame = self._ordered.popleft()
+        elif self._latest:
+            frame = self._latest.popitem(last=False)[1]
+        else:
+            return None
+        self._bytes -= frame_size(frame)
+        return frame
+
+    async def _run(self):
+        while not self._closed:
+            frame = self._next()
+            if frame is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            metrics.gauge_add(QUEUE_DEPTH, -1)
+            await self.send(**frame)
+
+    def close(self):
+        """Stop sending and release whatever is still queued."""
+        if self._closed:
+            return
+        self._closed = True
+        metrics.gauge_add(QUEUE_DEPTH, -len(self))
+        self._ordered.clear()
+        self._latest.clear()
+        self._bytes = 0
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
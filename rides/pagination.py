@@ -0,0 +1,122 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are selected by filtering on the sort tuple of the last row returned
+instead of OFFSET, and no COUNT is issued, so every page costs the same no
+matter how deep the client goes. Cursors are signed, opaque tokens.
+"""
+from bisect import bisect_right
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+
+
+class KeysetPagination:
+    page_size = 10
+    cursor_query_param = "cursor"
+    # Sort tuple; prefix a field with "-" for descending. Must end in a unique field.
+    ordering = ("-created_at", "-id")
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, ordering=None):
+        if ordering is not None:
+            self.ordering = tuple(ordering)
+        self.next_cursor = None
+
+    @property
+    def fields(self):
+        return [field.lstrip("-") for field in self.ordering]
+
+    def _salt(self):
+        return f"rides.pagination:{','.join(self.ordering)}"
+
+    def encode_cursor(self, values):
+        return signing.dumps(
+            [value.isoformat() if isinstance(value, datetime) else value for value in values],
+            salt=self._salt(),
+            compress=True,
+        )
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if token is None and isinstance(request.data, dict):
+            token = request.data.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            values = signing.loads(token, salt=self._salt())
+        except signing.BadSignature:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return [
+            (parse_datetime(value) or value) if isinstance(value, str) else value
+            for value in values
+        ]
+
+    def _after(self, values):
+        """Rows strictly after `values` in the sort order."""
+        fields = self.fields
+        condition = Q()
+        for position, field in enumerate(self.ordering):
+            lookup = "lt" if field.startswith("-") else "gt"
+            branch = Q(**{f"{fields[position]}__{lookup}": values[position]})
+            for previous in range(position):
+                branch &= Q(**{fields[previous]: values[previous]})
+            condition |= branch
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.page_after(queryset, self.decode_cursor(request))
+
+    def page_after(self, queryset, values):
+        """One page of `queryset` following the sort key `values` (None: first page)."""
+        queryset = queryset.order_by(*self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(values))
+
+        rows = list(queryset[: self.page_size + 1])
+        page = rows[: self.page_size]
+        if len(rows) > self.page_size:
+            last = page[-1]
+            self.next_cursor = self.encode_cursor(
+                [getattr(last, field) for field in self.fields]
+            )
+        return page
+
+    def paginate_keys(self, keys, request):
+        """
+        Paginate a list of sort-key tuples that is already ordered by
+        `ordering` (ascending fields only), e.g. results from the search index.
+        """
+        values = self.decode_cursor(request)
+        if values is not None:
+            try:
+                keys = keys[bisect_right(keys, tuple(values)):]
+            except TypeError:
+                raise NotFound(self.invalid_cursor_message)
+
+        page = list(keys[: self.page_size])
+        if len(keys) > self.page_size:
+            self.next_cursor = self.encode_cursor(list(page[-1]))
+        return page
+
+
+class RideSearchPagination(KeysetPagination):
+    ordering = ("search_distance", "start_time", "id")
+
+
+class RideRequestPagination(KeysetPagination):
+    ordering = ("-created_at", "-id")
+
+
+class RideHistoryPagination(KeysetPagination):
+    ordering = ("-start_time", "-id")
+
+
+class ChatHistoryPagination(KeysetPagination):
+    page_size = 50
+    ordering = ("-timestamp", "-id")
@@ -0,0 +1,207 @@
+"""
+Quantized ride search result cache.
+
+Searches are snapped to a grid (pickup and destination cell centres, radius
+rounded up to a bucket and widened by half a cell diagonal), so passengers
+searching from the same campus gate share one cache entry. The entry holds
+the candidate rides of the snapped search (every ride the exact search could
+match, before the one-ride-per-driver rule) as IndexedRides, and each request
+narrows them to its own pickup, destination and radius with
+spatial_index.rank_matches. The cache only decides which rides are
+considered, never what is returned.
+
+Invalidation is driven by writes. The map is also divided into coarser
+invalidation regions, each with a version counter per side (start/end). An
+entry's key embeds the versions of every region its pickup and destination
+radius overlaps. When a ride is created, changes seats/status/time, or moves,
+the regions of its old and new endpoints are bumped, so only the entries that
+ride could appear in stop matching.
+"""
+import hashlib
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.db import transaction
+
+from rides.spatial_index import METRES_PER_DEGREE, rank_matches
+
+KEY_PREFIX = "rides:search_cache"
+HITS_KEY = f"{KEY_PREFIX}:hits"
+MISSES_KEY = f"{KEY_PREFIX}:misses"
+INVALIDATIONS_KEY = f"{KEY_PREFIX}:invalidations"
+
+# Ride fields that can change whether or where a ride appears in results
+SEARCH_FIELDS = ("status", "available_seats", "start_time", "start_point", "end_point")
+
+
+def is_enabled():
+    return settings.RIDE_SEARCH_CACHE_ENABLED
+
+
+def _cell(coords, size):
+    return math.floor(coords[0] / size), math.floor(coords[1] / size)
+
+
+def snap_point(point):
+    size = settings.RIDE_SEARCH_CACHE_CELL_DEGREES
+    x, y = _cell(point.coords, size)
+    return Point((x + 0.5) * size, (y + 0.5) * size, srid=4326)
+
+
+def snap_radius(radius):
+    step = settings.RIDE_SEARCH_CACHE_RADIUS_STEP
+    return float(max(1, math.ceil(radius / step)) * step)
+
+
+def cell_margin_m():
+    """Half the diagonal of a cell: the furthest a point is from its snapped centre."""
+    return settings.RIDE_SEARCH_CACHE_CELL_DEGREES * METRES_PER_DEGREE * math.sqrt(2) / 2
+
+
+def quantize(data):
+    """
+    The grid search covering `data`: snapped points, and a radius wide enough
+    that every ride within data["radius"] of the real points is inside it.
+    """
+    return {
+        **data,
+        "pickup_point": snap_point(data["pickup_point"]),
+        "destination_point": snap_point(data["destination_point"]),
+        "radius": snap_radius(data["radius"]) + math.ceil(cell_margin_m()),
+    }
+
+
+# Invalidation regions
+
+
+def _region(coords):
+    return _cell(coords, settings.RIDE_SEARCH_CACHE_REGION_DEGREES)
+
+
+def _region_bounds(coords, radius_m):
+    lat_span = radius_m / METRES_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(coords[1])), 1e-6)
+    lon_span = min(radius_m / (METRES_PER_DEGREE * cos_lat), 180.0)
+    min_x, min_y = _region((coords[0] - lon_span, max(coords[1] - lat_span, -90.0)))
+    max_x, max_y = _region((coords[0] + lon_span, min(coords[1] + lat_span, 90.0)))
+    return min_x, min_y, max_x, max_y
+
+
+def _regions_within(coords, radius_m):
+    min_x, min_y, max_x, max_y = _region_bounds(coords, radius_m)
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def _region_count(data):
+    """How many version keys the entry of `data` would embed."""
+    count = 0
+    for point in (data["pickup_point"], data["destination_point"]):
+        min_x, min_y, max_x, max_y = _region_bounds(point.coords, data["radius"])
+        count += (max_x - min_x + 1) * (max_y - min_y + 1)
+    return count
+
+
+def _version_key(side, region):
+    return f"{KEY_PREFIX}:v:{side}:{region[0]}:{region[1]}"
+
+
+def _entry_key(data):
+    version_keys = [
+        _version_key("start", region)
+        for region in _regions_within(data["pickup_point"].coords, data["radius"])
+    ] + [
+        _version_key("end", region)
+        for region in _regions_within(data["destination_point"].coords, data["radius"])
+    ]
+    versions = cache.get_many(version_keys)
+    fingerprint = hashlib.blake2b(
+        ",".join(str(versions.get(key, 0)) for key in version_keys).encode(),
+        digest_size=8,
+    ).hexdigest()
+    pickup = _cell(data["pickup_point"].coords, settings.RIDE_SEARCH_CACHE_CELL_DEGREES)
+    destination = _cell(
+        data["destination_point"].coords, settings.RIDE_SEARCH_CACHE_CELL_DEGREES
+    )
+    return (
+        f"{KEY_PREFIX}:keys:{pickup[0]}:{pickup[1]}:{destination[0]}:{destination[1]}"
+        f":{data['seats_needed']}:{int(data['radius'])}:{fingerprint}"
+    )
+
+
+def _incr(key):
+    cache.add(key, 0, timeout=None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return None
+
+
+def search(data, load_rides):
+    """
+    (search_distance, start_time, id) keys of the rides matching `data`
+    exactly. The candidates come from the cache entry of the snapped search,
+    or from `load_rides(snapped_data)` on a miss. Searches spanning more than
+    RIDE_SEARCH_CACHE_MAX_REGIONS invalidation regions skip the cache.
+    """
+    snapped = quantize(data)
+    if _region_count(snapped) > settings.RIDE_SEARCH_CACHE_MAX_REGIONS:
+        # Too wide to key on its regions (e.g. near a pole); search directly
+        rides = load_rides(data)
+    else:
+        key = _entry_key(snapped)
+        rides = cache.get(key)
+        if rides is not None:
+            _incr(HITS_KEY)
+        else:
+            _incr(MISSES_KEY)
+            rides = list(load_rides(snapped))
+            cache.set(key, rides, timeout=settings.RIDE_SEARCH_CACHE_TTL)
+    return rank_matches(
+        rides,
+        data["pickup_point"].coords,
+        data["destination_point"].coords,
+        data["radius"],
+    )
+
+
+def invalidate_points(start_points, end_points):
+    regions = {("start", _region(p.coords)) for p in start_points if p is not None}
+    regions |= {("end", _region(p.coords)) for p in end_points if p is not None}
+    for side, region in regions:
+        _incr(_version_key(side, region))
+    if regions:
+        _incr(INVALIDATIONS_KEY)
+
+
+def ride_saved(ride, created):
+    """Called from post_save, before the ride's loaded values are refreshed."""
+    if not created and not ride.changed_fields(SEARCH_FIELDS):
+        return
+    start_points = [ride.start_point, ride.loaded_value("start_point")]
+    end_points = [ride.end_point, ride.loaded_value("end_point")]
+    transaction.on_commit(lambda: invalidate_points(start_points, end_points))
+
+
+def ride_deleted(ride):
+    start_points, end_points = [ride.start_point], [ride.end_point]
+    transaction.on_commit(lambda: invalidate_points(start_points, end_points))
+
+
+def stats():
+    counters = cache.get_many([HITS_KEY, MISSES_KEY, INVALIDATIONS_KEY])
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    return {
+        "enabled": is_enabled(),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        "invalidations": counters.get(INVALIDATIONS_KEY, 0),
+        "cell_degrees": settings.RIDE_SEARCH_CACHE_CELL_DEGREES,
+        "region_degrees": settings.RIDE_SEARCH_CACHE_REGION_DEGREES,
+        "radius_step": settings.RIDE_SEARCH_CACHE_RADIUS_STEP,
+        "ttl": settings.RIDE_SEARCH_CACHE_TTL,
+        "max_regions": settings.RIDE_SEARCH_CACHE_MAX_REGIONS,
+    }
@@ -1,12 +1,19 @@
-from django.contrib.gis.db.models.functions import Distance
+from django.conf import settings
+from django.contrib.gis.db.models.functions import Distance, LineLocatePoint
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
+from django.db import connection, transaction
+from django.db.models import (Exists, ExpressionWrapper, F, FloatField, Func,
+                              OuterRef, Prefetch, Q, Subquery)
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 from rest_framework import serializers
 
 from authentication.models import User
 
-from .models import PassengerRideRequest, Rating, RideDetails
+from . import search_cache
+from .models import ChatMessage, PassengerRideRequest, Rating, RideDetails
+from .spatial_index import get_pending_ride_index, indexed_ride
 
 
 class PointFieldSerializer(serializers.Field):
@@ -39,7 +46,7 @@ class RideDetailsSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = RideDetails
-        fields = "__all__"
+        exclude = ["start_geography", "end_geography", "route_geography"]
         read_only_fields = ["driver", "status"]
 
     def get_driver_name(self, obj):
@@ -130,40 +137,349 @@ class RideRequestSerializer(serializers.ModelSerializer):
 
 
 class RideSearchSerializer(serializers.Serializer):
+    MODE_ENDPOINTS = "endpoints"
+    MODE_CORRIDOR = "corridor"
+    MODE_NEAREST = "nearest"
+    SEARCH_ORDERING = ("search_distance", "start_time", "id")
+    CORRIDOR_ORDERING = ("detour", "start_time", "id")
+    DEFAULT_RADIUS = 5000.0
+    MAX_RADIUS = 50000.0
+    DEFAULT_K = 10
+    # Nearest mode fetches k * factor KNN candidates, growing up to the cap
+    NEAREST_CANDIDATE_FACTOR = 4
+    NEAREST_MAX_CANDIDATES = 1024
+
     pickup_point = PointFieldSerializer()
     destination_point = PointFieldSerializer()
     seats_needed = serializers.IntegerField(default=1, min_value=1, max_value=8)
-    radius = serializers.FloatField(default=5000.0, min_value=0.0)
+    # Endpoint and corridor modes only; defaults to DEFAULT_RADIUS metres
+    radius = serializers.FloatField(required=False, min_value=0.0, max_value=MAX_RADIUS)
+    mode = serializers.ChoiceField(
+        choices=[MODE_ENDPOINTS, MODE_CORRIDOR, MODE_NEAREST], default=MODE_ENDPOINTS
+    )
+    # Nearest mode only: how many rides to return; defaults to DEFAULT_K
+    k = serializers.IntegerField(required=False, min_value=1, max_value=50)
+
+    def validate(self, data):
+        # Reject rather than ignore the parameter the mode doesn't use
+        if data["mode"] == self.MODE_NEAREST:
+            if "radius" in data:
+                raise serializers.ValidationError(
+                    {"radius": "Nearest mode takes k instead of a radius"}
+                )
+            data["k"] = data.get("k", self.DEFAULT_K)
+        else:
+            if "k" in data:
+                raise serializers.ValidationError({"k": "k only applies to nearest mode"})
+            data["radius"] = data.get("radius", self.DEFAULT_RADIUS)
+        return data
+
+    def get_pending_rides(self):
+        return RideDetails.objects.filter(
+            status="PENDING",
+            available_seats__gte=self.validated_data["seats_needed"],
+            start_time__gt=timezone.now(),
+        )
+
+    def get_ordering(self):
+        """Sort tuple the results are paginated on."""
+        if self.validated_data["mode"] == self.MODE_CORRIDOR:
+            return self.CORRIDOR_ORDERING
+        return self.SEARCH_ORDERING
 
     def get_available_rides(self):
+        if self.validated_data["mode"] == self.MODE_CORRIDOR:
+            return self.get_corridor_rides()
+
         data = self.validated_data
-        current_time = timezone.now()
+        radius = D(m=data["radius"])
 
-        # First get all pending rides within radius and seat requirements
-        rides = (
-            RideDetails.objects.filter(
-                status="PENDING",
-                available_seats__gte=data["seats_needed"],
-                start_time__gt=current_time  
+        # Filter with index-backed dwithin on the geography columns first, so
+        # distances are only computed for the rides that actually match.
+        latest_per_driver = (
+            self.get_pending_rides()
+            .filter(
+                start_geography__dwithin=(data["pickup_point"], radius),
+                end_geography__dwithin=(data["destination_point"], radius),
             )
+            # First order by driver_id (for DISTINCT ON) and created_at (for most recent)
+            .order_by('driver_id', '-created_at', 'start_time')
+            .distinct('driver_id')
+        )
+
+        rides = (
+            RideDetails.objects.filter(id__in=Subquery(latest_per_driver.values("id")))
+            .select_related("driver")
             .annotate(
-                distance_to_pickup=Distance("start_point", data["pickup_point"]),
+                distance_to_pickup=Distance("start_geography", data["pickup_point"]),
                 distance_to_destination=Distance(
-                    "end_point", data["destination_point"]
+                    "end_geography", data["destination_point"]
+                ),
+                search_distance=ExpressionWrapper(
+                    Distance("start_geography", data["pickup_point"]),
+                    output_field=FloatField(),
+                ),
+            )
+            .order_by(*self.SEARCH_ORDERING)
+        )
+
+        return rides
+
+    def uses_search_index(self):
+        return (
+            settings.RIDE_SEARCH_INDEX_ENABLED
+            and self.validated_data["mode"] == self.MODE_ENDPOINTS
+        )
+
+    def searches_by_key(self):
+        """True when results come back as a sort-key list to hydrate per page."""
+        return self.validated_data["mode"] == self.MODE_ENDPOINTS and (
+            settings.RIDE_SEARCH_INDEX_ENABLED or search_cache.is_enabled()
+        )
+
+    def get_available_ride_keys(self):
+        """
+        (search_distance, start_time, id) tuples of the matching rides in
+        result order, served from the quantized result cache and/or the
+        in-process grid index when they are enabled.
+        """
+        if search_cache.is_enabled() and self.validated_data["mode"] == self.MODE_ENDPOINTS:
+            return search_cache.search(self.validated_data, self.load_matching_rides)
+        return self.search_ride_keys()
+
+    def load_matching_rides(self, data):
+        """
+        Every ride with both endpoints within data["radius"] and enough
+        seats, as IndexedRides, before the one-ride-per-driver rule.
+        """
+        if self.uses_search_index():
+            return get_pending_ride_index().matching_rides(
+                pickup=data["pickup_point"].coords,
+                destination=data["destination_point"].coords,
+                seats_needed=data["seats_needed"],
+                radius_m=data["radius"],
+            )
+
+        radius = D(m=data["radius"])
+        rides = self.get_pending_rides().filter(
+            start_geography__dwithin=(data["pickup_point"], radius),
+            end_geography__dwithin=(data["destination_point"], radius),
+        ).only(
+            "id", "driver_id", "start_point", "end_point", "available_seats",
+            "start_time", "created_at",
+        )
+        return [indexed_ride(ride) for ride in rides]
+
+    def search_ride_keys(self):
+        if not self.uses_search_index():
+            return list(
+                self.get_available_rides().values_list(*self.SEARCH_ORDERING)
+            )
+
+        data = self.validated_data
+        return get_pending_ride_index().search(
+            pickup=data["pickup_point"].coords,
+            destination=data["destination_point"].coords,
+            seats_needed=data["seats_needed"],
+            radius_m=data["radius"],
+        )
+
+    def get_nearest_rides(self):
+        """
+        The k rides with the lowest combined walking distance (home to pickup
+        plus drop-off to destination), without a fixed radius.
+
+        Only each driver's most recent pending ride is considered, so one
+        driver can't fill the results; a NOT EXISTS probe on driver_id keeps
+        that per row instead of a DISTINCT ON over every pending ride.
+        Candidates come from a KNN scan (`<->` on the start_geography GiST
+        index) and are re-ranked by walking cost. A ride outside the
+        candidate set walks at least as far to its pickup as the furthest
+        candidate, so once the k-th cost is within that bound no other ride
+        can beat it and the search stops; otherwise the candidate set grows,
+        up to a cap.
+        """
+        data = self.validated_data
+        pickup = data["pickup_point"]
+        destination = data["destination_point"]
+        k = data["k"]
+
+        eligible = self.get_pending_rides().filter(
+            start_geography__isnull=False, end_geography__isnull=False
+        )
+        # Same order as endpoint mode's DISTINCT ON: newest first, then earliest start
+        newer_ride = eligible.filter(driver_id=OuterRef("driver_id")).filter(
+            Q(created_at__gt=OuterRef("created_at"))
+            | Q(created_at=OuterRef("created_at"), start_time__lt=OuterRef("start_time"))
+            | Q(
+                created_at=OuterRef("created_at"),
+                start_time=OuterRef("start_time"),
+                id__lt=OuterRef("id"),
+            )
+        )
+        rides = (
+            eligible.filter(~Exists(newer_ride))
+            .select_related("driver")
+            .annotate(
+                pickup_walk=ExpressionWrapper(
+                    Distance("start_geography", pickup), output_field=FloatField()
+                ),
+                dropoff_walk=ExpressionWrapper(
+                    Distance("end_geography", destination), output_field=FloatField()
                 ),
             )
+            .order_by(
+                Func(
+                    F("start_geography"),
+                    RawSQL("ST_GeogFromText(%s)", (pickup.ewkt,)),
+                    template="%(expressions)s",
+                    arg_joiner=" <-> ",
+                    output_field=FloatField(),
+                )
+            )
+        )
+
+        limit = min(k * self.NEAREST_CANDIDATE_FACTOR, self.NEAREST_MAX_CANDIDATES)
+        while True:
+            candidates = list(rides[:limit])
+            for ride in candidates:
+                ride.walking_cost = ride.pickup_walk + ride.dropoff_walk
+            best = sorted(
+                candidates, key=lambda ride: (ride.walking_cost, ride.start_time, ride.id)
+            )[:k]
+
+            exhausted = len(candidates) < limit
+            bound = max((ride.pickup_walk for ride in candidates), default=0)
+            if (
+                exhausted
+                or limit >= self.NEAREST_MAX_CANDIDATES
+                or (len(best) == k and best[-1].walking_cost <= bound)
+            ):
+                return best
+            limit = min(limit * 4, self.NEAREST_MAX_CANDIDATES)
+
+    def get_corridor_rides(self):
+        """
+        Rides whose route passes within `radius` of both the pickup and the
+        destination, with the pickup coming first along the route.
+        """
+        data = self.validated_data
+        pickup = data["pickup_point"]
+        destination = data["destination_point"]
+        radius = D(m=data["radius"])
+
+        return (
+            self.get_pending_rides()
+            .select_related("driver")
+            # Both dwithin filters run against the GiST index on route_geography
             .filter(
-                distance_to_pickup__lte=D(m=data["radius"]),
-                distance_to_destination__lte=D(m=data["radius"]),
+                route_geography__dwithin=(pickup, radius),
             )
-            # First order by driver_id (for DISTINCT ON) and created_at (for most recent)
-            .order_by('driver_id', '-created_at', 'start_time')
-            .distinct('driver_id')
+            .filter(
+                route_geography__dwithin=(destination, radius),
+            )
+            .annotate(
+                pickup_position=LineLocatePoint("route_line", pickup),
+                dropoff_position=LineLocatePoint("route_line", destination),
+            )
+            .filter(pickup_position__lt=F("dropoff_position"))
+            .annotate(
+                detour=ExpressionWrapper(
+                    Distance("route_geography", pickup)
+                    + Distance("route_geography", destination),
+                    output_field=FloatField(),
+                ),
+            )
+            .order_by(*self.CORRIDOR_ORDERING)
         )
 
-        return rides
 
+class RideBatchSearchSerializer(serializers.Serializer):
+    MAX_QUERIES = 10
+
+    queries = RideSearchSerializer(many=True)
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=50)
 
+    def validate_queries(self, queries):
+        if not queries:
+            raise serializers.ValidationError("At least one query is required")
+        if len(queries) > self.MAX_QUERIES:
+            raise serializers.ValidationError(
+                f"At most {self.MAX_QUERIES} queries are allowed per batch"
+            )
+        if any(query["mode"] != RideSearchSerializer.MODE_ENDPOINTS for query in queries):
+            raise serializers.ValidationError("Batch search only supports endpoint mode")
+        return queries
+
+    def get_available_ride_ids(self):
+        """
+        Run every query in one round trip: the queries are a VALUES table
+        LATERAL-joined against the rides, each side using the same
+        index-backed predicates as RideSearchSerializer. Returns one ordered
+        id list per query.
+        """
+        queries = self.validated_data["queries"]
+        table = RideDetails._meta.db_table
+        rows_sql = []
+        params = []
+        for position, query in enumerate(queries):
+            rows_sql.append(
+                "(%s::integer,"
+                " ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography,"
+                " ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography,"
+                " %s::integer, %s::float8)"
+            )
+            params += [
+                position,
+                query["pickup_point"].x,
+                query["pickup_point"].y,
+                query["destination_point"].x,
+                query["destination_point"].y,
+                query["seats_needed"],
+                query["radius"],
+            ]
+        params += [timezone.now(), self.validated_data["limit"]]
+
+        sql = f"""
+            SELECT q.position, match.id
+            FROM (VALUES {", ".join(rows_sql)})
+                AS q(position, pickup, destination, seats_needed, radius)
+            CROSS JOIN LATERAL (
+                SELECT ride.id, ride.start_time,
+                       ST_Distance(ride.start_geography, q.pickup) AS search_distance
+                FROM (
+                    SELECT DISTINCT ON (driver_id) id, start_geography, start_time
+                    FROM {table}
+                    WHERE status = 'PENDING'
+                      AND available_seats >= q.seats_needed
+                      AND start_time > %s
+                      AND ST_DWithin(start_geography, q.pickup, q.radius)
+                      AND ST_DWithin(end_geography, q.destination, q.radius)
+                    ORDER BY driver_id, created_at DESC, start_time
+                ) AS ride
+                ORDER BY search_distance, ride.start_time, ride.id
+                LIMIT %s
+            ) AS match
+            ORDER BY q.position, match.search_distance, match.start_time, match.id
+        """
+        results = [[] for _ in queries]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for position, ride_id in cursor.fetchall():
+                results[position].append(ride_id)
+        return results
+
+
+class RideNearestMatchSerializer(RideDetailsSerializer):
+    pickup_walk = serializers.FloatField(read_only=True)  # metres
+    dropoff_walk = serializers.FloatField(read_only=True)  # metres
+    walking_cost = serializers.FloatField(read_only=True)
+
+
+class RideCorridorMatchSerializer(RideDetailsSerializer):
+    pickup_position = serializers.FloatField(read_only=True)
+    dropoff_position = serializers.FloatField(read_only=True)
+    detour = serializers.FloatField(read_only=True)  # metres, pickup + drop-off
 
 
 class RideActionSerializer(serializers.Serializer):
@@ -203,11 +519,14 @@ class RideStatusSerializer(serializers.Serializer):
 
     def update_status(self, ride):
         new_status = self.validated_data["status"]
-        ride.status = new_status
-        ride.save()
+        # The ride's post_save rebuilds the snapshot and invalidates access on
+        # commit, after the bulk request update
+        with transaction.atomic():
+            ride.status = new_status
+            ride.save()
 
-        if new_status in ["COMPLETED", "CANCELLED"]:
-            ride.requests.filter(status="CONFIRMED").update(status=new_status)
+            if new_status in ["COMPLETED", "CANCELLED"]:
+                ride.requests.filter(status="CONFIRMED").update(status=new_status)
 
         return {"message": f"Ride status updated to {new_status}"}
 
@@ -298,10 +617,27 @@ class RideStatusDetailsSerializer(serializers.ModelSerializer):
             "completed_rides_as_driver": obj.driver.completed_rides_as_driver,
         }
 
-    def get_passenger_requests(self, obj):
-        requests = obj.requests.filter(
-            status__in=["CONFIRMED", "COMPLETED", "IN_VEHICLE"]
+    PASSENGER_REQUEST_STATUSES = ["CONFIRMED", "COMPLETED", "IN_VEHICLE"]
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Load the driver and visible passenger requests up front (2 queries total)."""
+        return queryset.select_related("driver").prefetch_related(
+            Prefetch(
+                "requests",
+                queryset=PassengerRideRequest.objects.filter(
+                    status__in=cls.PASSENGER_REQUEST_STATUSES
+                ).select_related("passenger"),
+                to_attr="visible_requests",
+            )
         )
+
+    def get_passenger_requests(self, obj):
+        requests = getattr(obj, "visible_requests", None)
+        if requests is None:
+            requests = obj.requests.filter(
+                status__in=self.PASSENGER_REQUEST_STATUSES
+            ).select_related("passenger")
         return [
             {
                 "request_id": req.id,
@@ -356,8 +692,27 @@ class RideHistorySerializer(serializers.ModelSerializer):
 
 
 
+    PASSENGER_REQUEST_STATUSES = ['CONFIRMED', 'COMPLETED']
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Load the driver and history passenger requests up front (2 queries total)."""
+        return queryset.select_related('driver').prefetch_related(
+            Prefetch(
+                'requests',
+                queryset=PassengerRideRequest.objects.filter(
+                    status__in=cls.PASSENGER_REQUEST_STATUSES
+                ).select_related('passenger'),
+                to_attr='visible_requests',
+            )
+        )
+
     def get_passenger_requests(self, obj):
-        requests = obj.requests.filter(status__in=['CONFIRMED', 'COMPLETED'])
+        requests = getattr(obj, 'visible_requests', None)
+        if requests is None:
+            requests = obj.requests.filter(
+                status__in=self.PASSENGER_REQUEST_STATUSES
+            ).select_related('passenger')
         return RideRequestSerializer(requests, many=True).data
 
 
@@ -365,6 +720,12 @@ class RideHistorySerializer(serializers.ModelSerializer):
 
 
 
+class ChatMessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatMessage
+        fields = ["id", "message_id", "sender", "receiver", "message", "timestamp"]
+
+
 class CalculationBreakdownSerializer(serializers.Serializer):
     distance_km = serializers.FloatField()
     emission_factor_g_per_km = serializers.IntegerField()
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from authentication.models import User
+from rides import access, location, search_cache, snapshots, spatial_index
+from rides.models import PassengerRideRequest, RideDetails
+
+
+@receiver(post_save, sender=RideDetails)
+def ride_saved(sender, instance, created, **kwargs):
+    if settings.RIDE_SEARCH_INDEX_ENABLED:
+        transaction.on_commit(lambda: spatial_index.ride_saved(instance))
+    if search_cache.is_enabled():
+        search_cache.ride_saved(instance, created)
+    snapshots.schedule_rebuild(instance.id)
+    if not created and instance.changed_fields(["status"]):
+        access.schedule_invalidate(instance.id)
+        if instance.status in ["COMPLETED", "CANCELLED"]:
+            ride_id = instance.id
+            transaction.on_commit(lambda: location.forget_ride(ride_id))
+
+
+@receiver(post_delete, sender=RideDetails)
+def ride_deleted(sender, instance, **kwargs):
+    if settings.RIDE_SEARCH_INDEX_ENABLED:
+        ride_id = instance.id
+        transaction.on_commit(lambda: spatial_index.ride_deleted(ride_id))
+    if search_cache.is_enabled():
+        search_cache.ride_deleted(instance)
+    snapshots.schedule_rebuild(instance.id)
+    access.schedule_invalidate(instance.id)
+
+
+@receiver(post_save, sender=PassengerRideRequest)
+@receiver(post_delete, sender=PassengerRideRequest)
+def ride_request_changed(sender, instance, created=False, **kwargs):
+    snapshots.schedule_rebuild(instance.ride_id)
+    # A new pending request grants no access, everything else may change it
+    if not (created and instance.status == "PENDING"):
+        access.schedule_invalidate(instance.ride_id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    if not created:
+        user_id = instance.id
+        transaction.on_commit(lambda: snapshots.invalidate_for_user(user_id))
@@ -0,0 +1,109 @@
+"""
+Denormalized ride snapshots for RideStatusDetailsView.
+
+A snapshot is the serialized RideStatusDetailsSerializer payload (driver
+details, seat counts, confirmed passengers) plus the ids of the users allowed
+to read it, stored under one cache key per ride. Reads are two cache gets
+(version, snapshot); the snapshot is rebuilt when the ride, one of its
+requests, or one of its users changes (see rides.signals).
+
+The key is versioned like the access cache: every rebuild or invalidation
+moves the ride to a new version, and a read that missed only adds its
+snapshot under the version it started from. A slow read can therefore never
+overwrite a newer snapshot with stale data.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+
+def snapshot_key(ride_id):
+    return f"rides:snapshot:{ride_id}"
+
+
+def _version_key(ride_id):
+    return f"rides:snapshot:version:{ride_id}"
+
+
+def _bump_version(ride_id):
+    cache.add(_version_key(ride_id), 0, timeout=None)
+    try:
+        return cache.incr(_version_key(ride_id))
+    except ValueError:
+        return cache.get(_version_key(ride_id), 0)
+
+
+def _load_snapshot(ride_id):
+    from rides.models import PassengerRideRequest, RideDetails
+    from rides.serializers import RideStatusDetailsSerializer
+
+    try:
+        ride = RideStatusDetailsSerializer.setup_eager_loading(
+            RideDetails.objects.filter(id=ride_id)
+        ).get()
+    except RideDetails.DoesNotExist:
+        return None
+
+    member_ids = {ride.driver_id}
+    member_ids.update(
+        PassengerRideRequest.objects.filter(ride_id=ride_id).values_list(
+            "passenger_id", flat=True
+        )
+    )
+    return {
+        "data": RideStatusDetailsSerializer(ride).data,
+        "driver_id": ride.driver_id,
+        "member_ids": sorted(member_ids),
+    }
+
+
+def build_snapshot(ride_id):
+    """Rebuild after a write, under a new version."""
+    version = _bump_version(ride_id)
+    snapshot = _load_snapshot(ride_id)
+    if snapshot is not None:
+        cache.set(
+            snapshot_key(ride_id), snapshot, timeout=settings.RIDE_SNAPSHOT_TTL, version=version
+        )
+    return snapshot
+
+
+def get_snapshot(ride_id):
+    version = cache.get(_version_key(ride_id), 0)
+    snapshot = cache.get(snapshot_key(ride_id), version=version)
+    if snapshot is None:
+        snapshot = _load_snapshot(ride_id)
+        if snapshot is not None:
+            cache.add(
+                snapshot_key(ride_id),
+                snapshot,
+                timeout=settings.RIDE_SNAPSHOT_TTL,
+                version=version,
+            )
+    return snapshot
+
+
+def schedule_rebuild(ride_id):
+    """Rebuild once the current transaction commits."""
+    transaction.on_commit(lambda: build_snapshot(ride_id))
+
+
+def invalidate_for_user(user_id):
+    """Drop the snapshots showing this user's details; they rebuild on next read."""
+    from rides.models import RideDetails
+
+    ride_ids = (
+        RideDetails.objects.filter(Q(driver_id=user_id) | Q(requests__passenger_id=user_id))
+        .filter(
+            Q(status__in=["PENDING", "ONGOING"])
+            | Q(start_time__gte=timezone.now() - timedelta(days=1))
+        )
+        .values_list("id", flat=True)
+        .distinct()
+    )
+    for ride_id in ride_ids:
+        _bump_version(ride_id)
@@ -0,0 +1,276 @@
+"""
+In-process uniform grid index of searchable rides.
+
+Holds the PENDING rides with a future start_time, bucketed by the grid cell of
+their start and end points, so FindRidesView can answer searches without a
+PostGIS round trip. Each worker keeps its own copy:
+
+* writes in this process are applied directly from the RideDetails signals
+  (see rides.signals);
+* writes in other processes bump a generation counter in the shared cache, and
+  a worker that sees a newer generation reloads the (small) pending set.
+
+The index is only consulted when settings.RIDE_SEARCH_INDEX_ENABLED is set.
+"""
+import math
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+GENERATION_CACHE_KEY = "rides:search_index:generation"
+
+IndexedRide = namedtuple(
+    "IndexedRide",
+    ["id", "driver_id", "start", "end", "available_seats", "start_time", "created_at"],
+)
+
+
+def haversine_m(a, b):
+    """Great-circle distance in metres between two (lon, lat) pairs."""
+    lon1, lat1, lon2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def indexed_ride(ride):
+    return IndexedRide(
+        id=ride.id,
+        driver_id=ride.driver_id,
+        start=(ride.start_point.x, ride.start_point.y),
+        end=(ride.end_point.x, ride.end_point.y),
+        available_seats=ride.available_seats,
+        start_time=ride.start_time,
+        created_at=ride.created_at,
+    )
+
+
+def rank_matches(rides, pickup, destination, radius_m, now=None):
+    """
+    The SQL search applied to candidate IndexedRides: both endpoints within
+    `radius_m`, a future start, one ride per driver (the most recent).
+    Returns (search_distance, start_time, id) tuples in that order.
+    """
+    now = now or timezone.now()
+    by_driver = {}
+    for ride in rides:
+        if ride.start_time <= now or haversine_m(ride.end, destination) > radius_m:
+            continue
+        distance = haversine_m(ride.start, pickup)
+        if distance > radius_m:
+            continue
+        best = by_driver.get(ride.driver_id)
+        if best is None or (-ride.created_at.timestamp(), ride.start_time) < (
+            -best[1].created_at.timestamp(), best[1].start_time
+        ):
+            by_driver[ride.driver_id] = (distance, ride)
+    return sorted(
+        (distance, ride.start_time, ride.id) for distance, ride in by_driver.values()
+    )
+
+
+def is_searchable(ride, now=None):
+    return (
+        ride.status == "PENDING"
+        and ride.start_point is not None
+        and ride.end_point is not None
+        and ride.start_time > (now or timezone.now())
+    )
+
+
+class PendingRideIndex:
+    def __init__(self, cell_degrees=None, max_age=None):
+        self.cell_degrees = cell_degrees or settings.RIDE_SEARCH_INDEX_CELL_DEGREES
+        self.max_age = max_age if max_age is not None else settings.RIDE_SEARCH_INDEX_MAX_AGE
+        self._lock = threading.RLock()
+        self._rides = {}
+        self._start_cells = defaultdict(set)
+        self._end_cells = defaultdict(set)
+        self.generation = None
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self._rides)
+
+    def get(self, ride_id):
+        return self._rides.get(ride_id)
+
+    # Grid helpers
+
+    def cell_for(self, coords):
+        return (
+            math.floor(coords[0] / self.cell_degrees),
+            math.floor(coords[1] / self.cell_degrees),
+        )
+
+    def cell_bounds(self, coords, radius_m):
+        """(min_x, min_y, max_x, max_y) of the cells within `radius_m` of `coords`."""
+        lat_span = radius_m / METRES_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(coords[1])), 1e-6)
+        lon_span = min(radius_m / (METRES_PER_DEGREE * cos_lat), 180.0)
+        min_x, min_y = self.cell_for((coords[0] - lon_span, max(coords[1] - lat_span, -90.0)))
+        max_x, max_y = self.cell_for((coords[0] + lon_span, min(coords[1] + lat_span, 90.0)))
+        return min_x, min_y, max_x, max_y
+
+    # Maintenance
+
+    def load(self):
+        """Rebuild the index from the database."""
+        from rides.models import RideDetails
+
+        rides = RideDetails.objects.filter(
+            status="PENDING",
+            start_time__gt=timezone.now(),
+            start_point__isnull=False,
+            end_point__isnull=False,
+        ).only(
+            "id", "driver_id", "start_point", "end_point", "available_seats",
+            "start_time", "created_at", "status",
+        )
+        generation = cache.get(GENERATION_CACHE_KEY, 0)
+
+        with self._lock:
+            self._rides.clear()
+            self._start_cells.clear()
+            self._end_cells.clear()
+            for ride in rides.iterator(chunk_size=2000):
+                self._add(ride)
+            self.generation = generation
+            self.loaded_at = time.monotonic()
+
+    def ensure_fresh(self):
+        generation = cache.get(GENERATION_CACHE_KEY, 0)
+        stale = (
+            self.loaded_at is None
+            or generation != self.generation
+            or time.monotonic() - self.loaded_at > self.max_age
+        )
+        if stale:
+            self.load()
+
+    def update(self, ride):
+        """Apply a saved ride to this process and tell the other workers."""
+        with self._lock:
+            self._remove(ride.id)
+            if is_searchable(ride):
+                self._add(ride)
+        self._bump_generation()
+
+    def remove(self, ride_id):
+        with self._lock:
+            self._remove(ride_id)
+        self._bump_generation()
+
+    def _add(self, ride):
+        entry = indexed_ride(ride)
+        self._rides[entry.id] = entry
+        self._start_cells[self.cell_for(entry.start)].add(entry.id)
+        self._end_cells[self.cell_for(entry.end)].add(entry.id)
+
+    def _remove(self, ride_id):
+        entry = self._rides.pop(ride_id, None)
+        if entry is None:
+            return
+        for cells, coords in ((self._start_cells, entry.start), (self._end_cells, entry.end)):
+            cell = self.cell_for(coords)
+            cells[cell].discard(ride_id)
+            if not cells[cell]:
+                del cells[cell]
+
+    def _bump_generation(self):
+        generation = bump_generation()
+        # Our own write is already applied; only skip the reload if nobody
+        # else wrote in between.
+        if self.generation is not None and generation == self.generation + 1:
+            self.generation = generation
+
+    # Search
+
+    def _candidates(self, cells, coords, radius_m):
+        min_x, min_y, max_x, max_y = self.cell_bounds(coords, radius_m)
+        ids = set()
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(cells):
+            # Near a pole the range spans every longitude; walk the occupied cells instead
+            for (x, y), cell_ids in cells.items():
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    ids |= cell_ids
+            return ids
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                ids |= cells.get((x, y), set())
+        return ids
+
+    def matching_rides(self, pickup, destination, seats_needed, radius_m, now=None):
+        """Rides with both endpoints in cells near the search and enough seats."""
+        now = now or timezone.now()
+        with self._lock:
+            candidates = self._candidates(self._start_cells, pickup, radius_m)
+            if candidates:
+                candidates &= self._candidates(self._end_cells, destination, radius_m)
+            return [
+                self._rides[ride_id]
+                for ride_id in candidates
+                if self._rides[ride_id].available_seats >= seats_needed
+                and self._rides[ride_id].start_time > now
+            ]
+
+    def search(self, pickup, destination, seats_needed, radius_m, now=None):
+        """
+        Rides matching the SQL search: both endpoints within `radius_m`, enough
+        seats, one ride per driver (the most recent). Returns
+        (search_distance, start_time, id) tuples in that order.
+        """
+        now = now or timezone.now()
+        return rank_matches(
+            self.matching_rides(pickup, destination, seats_needed, radius_m, now),
+            pickup,
+            destination,
+            radius_m,
+            now,
+        )
+
+
+def bump_generation():
+    cache.add(GENERATION_CACHE_KEY, 0, timeout=None)
+    try:
+        return cache.incr(GENERATION_CACHE_KEY)
+    except ValueError:
+        # Evicted between add() and incr(); the next search reloads anyway
+        return None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_pending_ride_index():
+    """The process-wide index, loaded lazily on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PendingRideIndex()
+    _index.ensure_fresh()
+    return _index
+
+
+def ride_saved(ride):
+    if _index is not None:
+        _index.update(ride)
+    else:
+        bump_generation()
+
+
+def ride_deleted(ride_id):
+    if _index is not None:
+        _index.remove(ride_id)
+    else:
+        bump_generation()
@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timezone as dt_timezone
+
+from django.test import SimpleTestCase
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from rides import location_codec
+from rides.channel_layers import HashRing, placement_key
+from rides.outbound import OutboundQueue
+from rides.pagination import KeysetPagination, RideSearchPagination
+from rides.trails import encode_polyline, simplify
+
+
+class LocationCodecTests(SimpleTestCase):
+    def test_round_trip_with_motion(self):
+        position = {"latitude": 28.613939, "longitude": 77.209021, "heading": 270.5, "speed": 12.34}
+        frame = location_codec.encode_position(3, position, 1500)
+        self.assertEqual(len(frame), 20)
+        self.assertEqual(location_codec.decode_position(frame), position)
+
+    def test_round_trip_without_motion(self):
+        position = {"latitude": -33.868820, "longitude": 151.209296}
+        frame = location_codec.encode_position(1, position, 0)
+        self.assertEqual(len(frame), 16)
+        self.assertEqual(location_codec.decode_position(frame), position)
+
+    def test_rejects_malformed_frames(self):
+        frame = location_codec.encode_position(
+            1, {"latitude": 1.0, "longitude": 2.0, "heading": 0.0, "speed": 0.0}, 0
+        )
+        self.assertIsNone(location_codec.decode_position(frame[:10]))
+        # Motion flag set but the motion fields are missing
+        self.assertIsNone(location_codec.decode_position(frame[:16]))
+        self.assertIsNone(location_codec.decode_position(b"\x02" + frame[1:]))
+
+
+class TrailTests(SimpleTestCase):
+    def test_simplify_drops_points_within_tolerance(self):
+        # The middle point is about 1.1 m off the line between its neighbours
+        points = [(0.0, 0.0, 1), (0.001, 0.00001, 2), (0.002, 0.0, 3)]
+        self.assertEqual(simplify(points, 3), [points[0], points[2]])
+        self.assertEqual(simplify(points, 0.5), points)
+
+    def test_simplify_keeps_corners(self):
+        points = [(0.0, 0.0, 1), (0.0005, 0.0, 2), (0.001, 0.0, 3), (0.001, 0.001, 4)]
+        self.assertEqual(simplify(points, 3), [points[0], points[2], points[3]])
+
+    def test_encode_polyline_matches_reference(self):
+        # The example from Google's encoded polyline algorithm documentation
+        coordinates = [(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)]
+        self.assertEqual(encode_polyline(coordinates), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+
+class HashRingTests(SimpleTestCase):
+    def test_groups_of_a_ride_share_a_placement(self):
+        self.assertEqual(placement_key("ride_location_12_driver"), "ride:12")
+        self.assertEqual(placement_key("ride_access_12"), "ride:12")
+        self.assertEqual(placement_key("chat_ride_12_user_3_7"), "ride:12")
+        self.assertEqual(placement_key("specific.abc!def"), "specific.abc!def")
+
+    def test_adding_a_shard_moves_only_its_share(self):
+        keys = [f"ride:{ride_id}" for ride_id in range(10000)]
+        before, after = HashRing(3), HashRing(4)
+        moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+        self.assertTrue(all(after.shard_for(key) == 3 for key in moved))
+        self.assertLess(abs(len(moved) / len(keys) - 0.25), 0.05)
+
+
+class KeysetCursorTests(SimpleTestCase):
+    def request(self, cursor):
+        return Request(APIRequestFactory().get("/", {"cursor": cursor}))
+
+    def test_round_trip(self):
+        paginator = KeysetPagination()
+        values = [datetime(2024, 5, 1, 8, 30, tzinfo=dt_timezone.utc), 42]
+        cursor = paginator.encode_cursor(values)
+        self.assertEqual(paginator.decode_cursor(self.request(cursor)), values)
+
+    def test_rejects_tampered_cursor(self):
+        paginator = KeysetPagination()
+        cursor = paginator.encode_cursor([datetime(2024, 5, 1, tzinfo=dt_timezone.utc), 42])
+        tampered = cursor[:-1] + ("A" if cursor[-1] != "A" else "B")
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor(self.request(tampered))
+
+    def test_rejects_cursor_of_another_ordering(self):
+        cursor = RideSearchPagination().encode_cursor([120.5, "2024-05-01T08:30:00+00:00", 7])
+        with self.assertRaises(NotFound):
+            KeysetPagination().decode_cursor(self.request(cursor))
+
+    def test_paginate_keys_resumes_after_cursor(self):
+        start = datetime(2024, 5, 1, tzinfo=dt_timezone.utc)
+        keys = [(float(distance), start, distance) for distance in range(25)]
+        paginator = RideSearchPagination()
+        first = paginator.paginate_keys(keys, self.request(""))
+        second = RideSearchPagination().paginate_keys(
+            keys, self.request(paginator.next_cursor)
+        )
+        self.assertEqual(first, keys[:10])
+        self.assertEqual(second, keys[10:20])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def make_queue(self, **limits):
+        self.sent = []
+        self.overflowed = False
+        self.gate = asyncio.Event()
+
+        async def send(**frame):
+            self.sent.append(frame["text_data"])
+            await self.gate.wait()
+
+        async def on_overflow():
+            self.overflowed = True
+
+        return OutboundQueue(send, on_overflow, **limits)
+
+    async def test_latest_frame_per_key_wins_and_ordered_frames_go_first(self):
+        queue = self.make_queue(max_ordered=10, max_bytes=1000)
+        queue.put(text_data="hello")
+        await asyncio.sleep(0)  # the sender is now blocked on "hello"
+        queue.put_latest(7, text_data="position 1")
+        queue.put_latest(7, text_data="position 2")
+        queue.put(text_data="chat")
+        self.assertEqual(len(queue), 2)
+
+        self.gate.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(self.sent, ["hello", "chat", "position 2"])
+        queue.close()
+
+    async def test_too_many_ordered_frames_overflow(self):
+        queue = self.make_queue(max_ordered=2, max_bytes=1000)
+        for text in ("a", "b", "c"):
+            queue.put(text_data=text)
+        await asyncio.sleep(0)
+        self.assertTrue(self.overflowed)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.sent, [])
+
+    async def test_queued_bytes_of_any_kind_overflow(self):
+        queue = self.make_queue(max_ordered=10, max_bytes=10)
+        queue.put_latest(1, text_data="x" * 8)
+        # Replacing a keyed frame frees its bytes
+        queue.put_latest(1, text_data="y" * 8)
+        self.assertFalse(self.overflowed)
+        queue.put(text_data="abc")
+        await asyncio.sleep(0)
+        self.assertTrue(self.overflowed)
+        self.assertEqual(len(queue), 0)
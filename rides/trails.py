@@ -0,0 +1,288 @@
+"""
+Write-behind persistence of ride location trails.
+
+RideLocationConsumer hands every published position to the process-wide
+TrailBuffer, which only appends to an in-memory list. The buffer is flushed
+to LocationTrailPoint in one bulk insert when it reaches
+RIDE_TRAIL_BATCH_SIZE points or RIDE_TRAIL_FLUSH_INTERVAL seconds after the
+first buffered one, on a single background task, so the receive path never
+touches the database. Each rider's points are downsampled with
+Douglas-Peucker before they are written.
+
+Sockets leaving don't force a flush (a reconnect storm would become a
+flush storm); whatever is buffered goes out with the next batch, or when
+the process exits. A failed batch is put back and retried, but at most
+RIDE_TRAIL_MAX_BUFFERED points are kept: beyond that the oldest are dropped
+and counted in the trail_points_dropped metric.
+"""
+import asyncio
+import atexit
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from rides import metrics
+from rides.spatial_index import METRES_PER_DEGREE, haversine_m
+
+logger = logging.getLogger(__name__)
+
+
+def _offset_m(origin, point):
+    """Local equirectangular (x, y) in metres of `point` relative to `origin`."""
+    scale = math.cos(math.radians(origin[1]))
+    return (
+        (point[0] - origin[0]) * METRES_PER_DEGREE * scale,
+        (point[1] - origin[1]) * METRES_PER_DEGREE,
+    )
+
+
+def _segment_distance_m(point, start, end):
+    px, py = _offset_m(start, point)
+    ex, ey = _offset_m(start, end)
+    length_sq = ex * ex + ey * ey
+    if length_sq == 0:
+        return math.hypot(px, py)
+    t = max(0.0, min(1.0, (px * ex + py * ey) / length_sq))
+    return math.hypot(px - t * ex, py - t * ey)
+
+
+def simplify(points, tolerance_m):
+    """
+    Douglas-Peucker over (longitude, latitude, ...) tuples.
+
+    Keeps the first and last point and every point that deviates more than
+    `tolerance_m` metres from the simplified line. Extra tuple members (the
+    timestamp) are carried through untouched.
+    """
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        worst, worst_index = 0.0, None
+        for index in range(first + 1, last):
+            distance = _segment_distance_m(points[index], points[first], points[last])
+            if distance > worst:
+                worst, worst_index = distance, index
+        if worst_index is not None and worst > tolerance_m:
+            keep[worst_index] = True
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def encode_polyline(coordinates, precision=5):
+    """Encoded polyline (Google format) for (longitude, latitude) pairs."""
+    factor = 10 ** precision
+    previous_lat = previous_lon = 0
+    encoded = []
+    for longitude, latitude in coordinates:
+        lat = round(latitude * factor)
+        lon = round(longitude * factor)
+        encoded.append(_encode_value(lat - previous_lat))
+        encoded.append(_encode_value(lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    return "".join(encoded)
+
+
+def trail_length_m(coordinates):
+    return sum(
+        haversine_m(start, end) for start, end in zip(coordinates, coordinates[1:])
+    )
+
+
+class TrailBuffer:
+    """
+    In-memory trail points per (ride_id, user_id) waiting to be written.
+
+    The last written point of every rider is kept as the anchor of its next
+    simplification pass, so consecutive batches join without a seam.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, tolerance_m=None, max_points=None):
+        self.batch_size = (
+            settings.RIDE_TRAIL_BATCH_SIZE if batch_size is None else batch_size
+        )
+        self.flush_interval = (
+            settings.RIDE_TRAIL_FLUSH_INTERVAL
+            if flush_interval is None
+            else flush_interval
+        )
+        self.tolerance_m = (
+            settings.RIDE_TRAIL_TOLERANCE if tolerance_m is None else tolerance_m
+        )
+        self.max_points = (
+            settings.RIDE_TRAIL_MAX_BUFFERED if max_points is None else max_points
+        )
+        self._points = defaultdict(list)
+        self._anchors = {}
+        self._departed = set()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._flush_task = None
+        self.written = 0
+        self.simplified_away = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, ride_id, user_id, position, recorded_at=None):
+        """Buffer one position; never blocks on the database."""
+        if recorded_at is None:
+            recorded_at = time.time()
+        with self._lock:
+            self._points[(ride_id, user_id)].append(
+                (position["longitude"], position["latitude"], recorded_at)
+            )
+            self._size += 1
+            size = self._size
+
+        if size >= self.batch_size:
+            self.flush_soon()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self.flush_soon)
+
+    def flush_soon(self):
+        """Start a background flush unless one is already running."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(
+                sync_to_async(self.flush, thread_sensitive=False)()
+            )
+            self._flush_task.add_done_callback(self._retry_later)
+        return self._flush_task
+
+    def _retry_later(self, task):
+        # Points put back by a failed flush, or buffered while it ran
+        if self._size and self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self.flush_soon)
+
+    async def flush_now(self):
+        """Wait for any running flush, then flush the rest on the same task."""
+        if self._flush_task is not None and not self._flush_task.done():
+            await asyncio.wait([self._flush_task])
+        return await self.flush_soon()
+
+    def _take(self):
+        with self._lock:
+            points, self._points = self._points, defaultdict(list)
+            self._size = 0
+        return points
+
+    def _requeue(self, points):
+        with self._lock:
+            for key, pending in points.items():
+                self._points[key][:0] = pending
+                self._size += len(pending)
+            overflow = self._size - self.max_points
+            if overflow <= 0:
+                return
+            # Every series is in time order, so the oldest points are a prefix of each
+            oldest = heapq.nsmallest(
+                overflow,
+                (
+                    (recorded_at, key)
+                    for key, series in self._points.items()
+                    for _, _, recorded_at in series
+                ),
+            )
+            for key, count in Counter(key for _, key in oldest).items():
+                del self._points[key][:count]
+            self._size -= overflow
+        metrics.incr("trail_points_dropped", overflow)
+        logger.warning("Trail buffer full, dropped the %s oldest points", overflow)
+
+    def _rows(self, points):
+        from django.contrib.gis.geos import Point
+        from rides.models import LocationTrailPoint
+
+        rows = []
+        anchors = {}
+        for (ride_id, user_id), pending in points.items():
+            anchor = self._anchors.get((ride_id, user_id))
+            series = [anchor, *pending] if anchor is not None else pending
+            kept = simplify(series, self.tolerance_m)
+            if anchor is not None:
+                kept = kept[1:]
+            self.simplified_away += len(pending) - len(kept)
+            anchors[(ride_id, user_id)] = series[-1]
+            rows.extend(
+                LocationTrailPoint(
+                    ride_id=ride_id,
+                    user_id=user_id,
+                    recorded_at=datetime.fromtimestamp(recorded_at, tz=dt_timezone.utc),
+                    point=Point(longitude, latitude, srid=4326),
+                )
+                for longitude, latitude, recorded_at in kept
+            )
+        return rows, anchors
+
+    def flush(self):
+        """Write everything buffered in one bulk insert; puts it back on failure."""
+        points = self._take()
+        if not points:
+            return 0
+        from rides.models import LocationTrailPoint
+
+        close_old_connections()
+        try:
+            rows, anchors = self._rows(points)
+            LocationTrailPoint.objects.bulk_create(rows, batch_size=self.batch_size)
+        except Exception:
+            logger.exception("Trail flush failed, keeping %s rides buffered", len(points))
+            self._requeue(points)
+            return 0
+        finally:
+            close_old_connections()
+        with self._lock:
+            self._anchors.update(anchors)
+            # Riders who left while their last points were being written
+            for key in self._departed:
+                self._anchors.pop(key, None)
+            self._departed.clear()
+        self.written += len(rows)
+        return len(rows)
+
+    def forget(self, ride_id, user_id):
+        """Drop the simplification anchor of a rider who left the stream."""
+        with self._lock:
+            self._anchors.pop((ride_id, user_id), None)
+            # Still buffered: the flush that writes them drops the new anchor
+            self._departed.add((ride_id, user_id))
+
+
+_buffer = None
+
+
+def get_trail_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = TrailBuffer()
+        atexit.register(_buffer.flush)
+    return _buffer
@@ -24,6 +24,11 @@ urlpatterns = [
     ),
     # passenger patterns will be these
     path("passenger/search/", FindRidesView.as_view(), name="passenger-search-rides"),
+    path(
+        "passenger/search/batch/",
+        BatchFindRidesView.as_view(),
+        name="passenger-batch-search-rides",
+    ),
     path(
         "passenger/<int:ride_id>/request/",
         CreateRideRequestView.as_view(),
@@ -54,6 +59,7 @@ urlpatterns = [
         RideStatusDetailsView.as_view(),
         name="ride-status-details",
     ),
+    path("status/<int:ride_id>/trail/", RideTrailView.as_view(), name="ride-trail"),
     path(
         "passenger/request/<int:request_id>/complete-payment/",
         CompletePaymentView.as_view(),
@@ -64,11 +70,22 @@ urlpatterns = [
         RideHistoryView.as_view(),
         name='ride-history'
         ),
+    path(
+        'ride-history/export/',
+        RideHistoryExportView.as_view(),
+        name='ride-history-export'
+        ),
     path(
         'emissions-savings/<int:ride_id>/',
         EmissionsSavingsView.as_view(),
         name='emissions-savings'
         ),
+    path(
+        "chat/<int:ride_id>/<int:partner_id>/history/",
+        ChatHistoryView.as_view(),
+        name="chat-history",
+    ),
+    path("metrics/", RideMetricsView.as_view(), name="ride-metrics"),
     
     
 
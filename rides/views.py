@@ -1,21 +1,29 @@
-from django.db.models import Q
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Least
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers, status
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
 from authentication.models import User
 
-from .models import PassengerRideRequest, RideDetails
+from . import channel_layers, metrics, search_cache, snapshots, trails
+from .chat_outbox import get_chat_outbox
+from .models import (ChatMessage, LocationTrailPoint, PassengerRideRequest,
+                     RideDetails)
+from .pagination import (ChatHistoryPagination, RideHistoryPagination,
+                         RideRequestPagination, RideSearchPagination)
 from .serializers import *
 
 
-class StandardPagination(PageNumberPagination):
-    page_size = 10
-
-
 from rest_framework.exceptions import NotFound
 
 
@@ -38,18 +46,72 @@ class CreateRideView(APIView):
 
 class FindRidesView(APIView):
     permission_classes = [IsAuthenticated]
-    pagination_class = StandardPagination
+    pagination_class = RideSearchPagination
 
     def post(self, request):
         serializer = RideSearchSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        rides = serializer.get_available_rides()
 
-        paginator = self.pagination_class()
-        paginated_rides = paginator.paginate_queryset(rides, request)
-        ride_serializer = RideDetailsSerializer(paginated_rides, many=True)
+        if serializer.validated_data["mode"] == RideSearchSerializer.MODE_NEAREST:
+            # Top-k results are a single, bounded page
+            rides = serializer.get_nearest_rides()
+            return Response(
+                {
+                    "success": True,
+                    "data": RideNearestMatchSerializer(rides, many=True).data,
+                    "next_cursor": None,
+                }
+            )
+
+        paginator = self.pagination_class(ordering=serializer.get_ordering())
+        if serializer.searches_by_key():
+            # The index/cache answers the search; the DB only hydrates this page
+            ride_ids = [
+                key[-1]
+                for key in paginator.paginate_keys(
+                    serializer.get_available_ride_keys(), request
+                )
+            ]
+            rides_by_id = RideDetails.objects.select_related("driver").in_bulk(ride_ids)
+            paginated_rides = [
+                rides_by_id[ride_id] for ride_id in ride_ids if ride_id in rides_by_id
+            ]
+        else:
+            rides = serializer.get_available_rides()
+            paginated_rides = paginator.paginate_queryset(rides, request)
+        if serializer.validated_data["mode"] == RideSearchSerializer.MODE_CORRIDOR:
+            ride_serializer = RideCorridorMatchSerializer(paginated_rides, many=True)
+        else:
+            ride_serializer = RideDetailsSerializer(paginated_rides, many=True)
+
+        return Response(
+            {
+                "success": True,
+                "data": ride_serializer.data,
+                "next_cursor": paginator.next_cursor,
+            }
+        )
+
+
+class BatchFindRidesView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = RideBatchSearchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = serializer.get_available_ride_ids()
+
+        # Every ride is serialized once, however many queries matched it
+        ride_ids = {ride_id for ride_ids in results for ride_id in ride_ids}
+        rides = RideDetails.objects.select_related("driver").filter(id__in=ride_ids)
+        rides_data = {
+            str(item["data"]["id"]): item["data"]
+            for item in RideDetailsSerializer(rides, many=True).data
+        }
 
-        return Response({"success": True, "data": ride_serializer.data})
+        return Response(
+            {"success": True, "data": {"rides": rides_data, "results": results}}
+        )
 
 
 class CreateRideRequestView(APIView):
@@ -65,25 +127,35 @@ class CreateRideRequestView(APIView):
 
 class ListRideRequestsView(APIView):
     permission_classes = [IsAuthenticated]
-    pagination_class = StandardPagination
+    pagination_class = RideRequestPagination
 
     def get(self, request, ride_id):
         ride = get_object_or_404(RideDetails, id=ride_id, driver=request.user)
-        requests = PassengerRideRequest.objects.filter(ride=ride, status="PENDING")
+        requests = PassengerRideRequest.objects.filter(
+            ride=ride, status="PENDING"
+        ).select_related("passenger")
 
         # Get paginated data
         paginator = self.pagination_class()
         paginated_requests = paginator.paginate_queryset(requests, request)
         serializer = RideRequestSerializer(paginated_requests, many=True)
 
-        return Response({"success": True, "data": serializer.data})
+        return Response(
+            {
+                "success": True,
+                "data": serializer.data,
+                "next_cursor": paginator.next_cursor,
+            }
+        )
 
 
 class ManageRideRequestView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, request_id):
-        ride_request = get_object_or_404(PassengerRideRequest, id=request_id)
+        ride_request = get_object_or_404(
+            PassengerRideRequest.objects.select_related("ride__driver"), id=request_id
+        )
         serializer = RideActionSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         result = serializer.perform_action(ride_request, request.user)
@@ -99,23 +171,27 @@ class RideStatusView(APIView):
         serializer.is_valid(raise_exception=True)
 
         new_status = serializer.validated_data["status"]
-        ride.status = new_status
-        ride.save()
-
-        if new_status == "COMPLETED":
-            request.user.completed_rides_as_driver += 1
-            request.user.save()
-            passengers_to_complete = ride.requests.filter(
-                status__in=["CONFIRMED", "IN_VEHICLE"]
-            )
-            for passenger_request in passengers_to_complete:
-                passenger_request.passenger.completed_rides_as_passenger += 1
-                passenger_request.passenger.save()
-            passengers_to_complete.update(status=new_status)
-        elif new_status == "CANCELLED":
-            ride.requests.filter(status__in=["CONFIRMED", "IN_VEHICLE"]).update(
-                status=new_status
-            )
+        # One transaction: the ride's post_save rebuilds the snapshot and
+        # invalidates access on commit, after the bulk request updates below
+        with transaction.atomic():
+            ride.status = new_status
+            ride.save()
+
+            if new_status == "COMPLETED":
+                request.user.completed_rides_as_driver += 1
+                request.user.save()
+                passengers_to_complete = ride.requests.filter(
+                    status__in=["CONFIRMED", "IN_VEHICLE"]
+                )
+                User.objects.filter(
+                    id__in=passengers_to_complete.values("passenger_id")
+                ).update(completed_rides_as_passenger=F("completed_rides_as_passenger") + 1)
+                passengers_to_complete.update(status=new_status)
+            elif new_status == "CANCELLED":
+                ride.requests.filter(status__in=["CONFIRMED", "IN_VEHICLE"]).update(
+                    status=new_status
+                )
+
         return Response(
             {
                 "success": True,
@@ -226,25 +302,66 @@ class RideStatusDetailsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, ride_id):
-        try:
-            ride = (
-                RideDetails.objects.filter(id=ride_id)
-                .filter(Q(driver=request.user) | Q(requests__passenger=request.user))
-                .distinct()
-                .get()
-            )
+        snapshot = snapshots.get_snapshot(ride_id)
+        if snapshot is not None and request.user.id in snapshot["member_ids"]:
+            return Response({"success": True, "data": snapshot["data"]})
 
-            serializer = RideStatusDetailsSerializer(ride)
-            return Response({"success": True, "data": serializer.data})
+        return Response(
+            {
+                "success": False,
+                "error": "Ride not found or you don't have permission to view it",
+            },
+            status=status.HTTP_404_NOT_FOUND,
+        )
 
-        except RideDetails.DoesNotExist:
-            return Response(
-                {
-                    "success": False,
-                    "error": "Ride not found or you don't have permission to view it",
-                },
-                status=status.HTTP_404_NOT_FOUND,
+
+class RideTrailView(APIView):
+    """
+    Replay of a ride's recorded location trails as NDJSON, one line per rider
+    with the trail as an encoded polyline (precision 5, latitude first).
+
+    Lines come from an async generator that loads one rider's trail per
+    sync_to_async call, so under ASGI the first line goes out before the
+    remaining trails are read.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, ride_id):
+        ride = get_object_or_404(RideDetails, id=ride_id)
+        if ride.driver_id != request.user.id and not ride.requests.filter(
+            passenger=request.user,
+            status__in=["CONFIRMED", "IN_VEHICLE", "COMPLETED"],
+        ).exists():
+            raise NotFound(detail="No matching ride found for the user.")
+
+        points = LocationTrailPoint.objects.filter(ride_id=ride_id)
+
+        async def rows():
+            user_ids = await sync_to_async(list)(
+                points.order_by("user_id").values_list("user_id", flat=True).distinct()
             )
+            for user_id in user_ids:
+                yield await sync_to_async(self.render_trail)(points, user_id)
+
+        return StreamingHttpResponse(rows(), content_type="application/x-ndjson")
+
+    def render_trail(self, points, user_id):
+        trail = list(
+            points.filter(user_id=user_id)
+            .order_by("recorded_at", "id")
+            .values_list("recorded_at", "point")
+        )
+        coordinates = [(point.x, point.y) for _, point in trail]
+        row = {
+            "user_id": user_id,
+            "started_at": trail[0][0],
+            "ended_at": trail[-1][0],
+            "points": len(coordinates),
+            "distance_m": round(trails.trail_length_m(coordinates), 1),
+            "polyline": trails.encode_polyline(coordinates),
+        }
+        return json.dumps(row, cls=JSONEncoder) + "\n"
 
 
 class CompletePaymentView(APIView):
@@ -262,30 +379,82 @@ class CompletePaymentView(APIView):
 
 class RideHistoryView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = RideHistoryPagination
 
-    def get(self, request):
-        user = request.user
-
+    @staticmethod
+    def get_history_querysets(user):
         #  rides where the user is the driver
-        driver_rides = RideDetails.objects.filter(
-            driver=user, status__in=["COMPLETED", "CANCELLED"]
+        driver_rides = RideHistorySerializer.setup_eager_loading(
+            RideDetails.objects.filter(driver=user, status__in=["COMPLETED", "CANCELLED"])
         )
 
         #  rides where the user is a passenger
-        passenger_rides = RideDetails.objects.filter(
-            requests__passenger=user, requests__status__in=["COMPLETED", "CANCELLED"]
-        ).distinct()
+        passenger_rides = RideHistorySerializer.setup_eager_loading(
+            RideDetails.objects.filter(
+                id__in=PassengerRideRequest.objects.filter(
+                    passenger=user, status__in=["COMPLETED", "CANCELLED"]
+                ).values("ride_id")
+            )
+        )
+        return {"as_driver": driver_rides, "as_passenger": passenger_rides}
 
-        driver_data = RideHistorySerializer(driver_rides, many=True).data
-        passenger_data = RideHistorySerializer(passenger_rides, many=True).data
+    def get(self, request):
+        data = {}
+        next_cursors = {}
+        for role, rides in self.get_history_querysets(request.user).items():
+            # Each list pages independently: ?as_driver_cursor=...&as_passenger_cursor=...
+            paginator = self.pagination_class()
+            paginator.cursor_query_param = f"{role}_cursor"
+            page = paginator.paginate_queryset(rides, request)
+            data[role] = RideHistorySerializer(page, many=True).data
+            next_cursors[role] = paginator.next_cursor
+
+        return Response({"success": True, "data": data, "next_cursors": next_cursors})
+
+
+class RideHistoryExportView(APIView):
+    """
+    Full ride history as NDJSON, one ride per line.
+
+    HTTP is served through ASGI, where a sync iterator given to
+    StreamingHttpResponse is consumed whole before the first byte goes out.
+    The rows come from an async generator instead, which fetches one keyset
+    page of rides (passenger requests prefetched) per sync_to_async call, so
+    memory stays flat however long the history is.
+    """
 
-        return Response(
-            {
-                "success": True,
-                "data": {"as_driver": driver_data, "as_passenger": passenger_data},
-            }
-        )
+    permission_classes = [IsAuthenticated]
+    chunk_size = 200
 
+    def get(self, request):
+        querysets = RideHistoryView.get_history_querysets(request.user)
+
+        async def rows():
+            for role, rides in querysets.items():
+                after = None
+                while True:
+                    lines, after = await sync_to_async(self.render_chunk)(role, rides, after)
+                    for line in lines:
+                        yield line
+                    if after is None:
+                        break
+
+        response = StreamingHttpResponse(rows(), content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="ride-history.ndjson"'
+        return response
+
+    def render_chunk(self, role, rides, after):
+        """NDJSON lines of the page after `after`, and the sort key to continue from."""
+        paginator = RideHistoryPagination()
+        paginator.page_size = self.chunk_size
+        page = paginator.page_after(rides, after)
+        lines = [
+            json.dumps({"role": role, **RideHistorySerializer(ride).data}, cls=JSONEncoder) + "\n"
+            for ride in page
+        ]
+        if paginator.next_cursor is None:
+            return lines, None
+        return lines, [getattr(page[-1], field) for field in paginator.fields]
 
 
 class EmissionsSavingsView(APIView):
@@ -354,3 +523,97 @@ class EmissionsSavingsView(APIView):
                     "user_id": request.user.id
                 }
             }, status=500)
+
+
+class ChatHistoryView(APIView):
+    """
+    Messages between the requesting user and `partner_id` in a ride, newest
+    first with cursor pagination. `?after=<message_id or id>` returns the
+    messages sent after that one instead, oldest first, to catch up after a
+    reconnect. Messages reach the table in batches (see rides.chat_outbox),
+    so the last fraction of a second may not be listed yet: an anchor that
+    isn't stored yet is looked up in this worker's outbox queue, and if it is
+    still unknown (queued in another worker, or being written) the answer is
+    an empty list rather than a 404 and the client retries.
+    """
+
+    permission_classes = [IsAuthenticated]
+    pagination_class = ChatHistoryPagination
+
+    def get(self, request, ride_id, partner_id):
+        # Only ever the requester's own conversation, so no further access check.
+        # Filtering on LEAST/GREATEST matches rides_chat_pair_timeline_idx.
+        user_id = request.user.id
+        messages = ChatMessage.objects.alias(
+            low=Least("sender", "receiver"), high=Greatest("sender", "receiver")
+        ).filter(
+            ride_id=ride_id, low=min(user_id, partner_id), high=max(user_id, partner_id)
+        )
+
+        after = request.query_params.get("after")
+        if after:
+            anchor = self.get_anchor(messages, after, ride_id, {user_id, partner_id})
+            if anchor is None:
+                return Response({"success": True, "data": [], "has_more": False})
+            paginator = self.pagination_class(ordering=("timestamp", "id"))
+            page = paginator.page_after(messages, list(anchor))
+            return Response(
+                {
+                    "success": True,
+                    "data": ChatMessageSerializer(page, many=True).data,
+                    "has_more": paginator.next_cursor is not None,
+                }
+            )
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(messages, request)
+        return Response(
+            {
+                "success": True,
+                "data": ChatMessageSerializer(page, many=True).data,
+                "next_cursor": paginator.next_cursor,
+            }
+        )
+
+    def get_anchor(self, messages, after, ride_id, user_ids):
+        """(timestamp, id) of the message the client last saw, None if unknown."""
+        if after.isdigit():
+            return (
+                messages.filter(id=int(after))
+                .values_list("timestamp", "id")
+                .first()
+            )
+        try:
+            message_id = uuid.UUID(after)
+        except ValueError:
+            raise NotFound(detail="Unknown message.")
+        anchor = (
+            messages.filter(message_id=message_id)
+            .order_by("timestamp", "id")
+            .values_list("timestamp", "id")
+            .first()
+        )
+        if anchor is None:
+            # Sent moments ago and not written yet: anything stored at that
+            # instant or later comes after it
+            timestamp = get_chat_outbox().queued_timestamp(message_id, ride_id, user_ids)
+            if timestamp is not None:
+                anchor = (timestamp, 0)
+        return anchor
+
+
+class RideMetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(
+            {
+                "success": True,
+                "data": {
+                    "search_cache": search_cache.stats(),
+                    # Per worker: only the process serving this request
+                    "websocket": metrics.snapshot(),
+                    "channel_layer": channel_layers.shard_health(),
+                },
+            }
+        )
@@ -0,0 +1,30 @@
+"""
+The default cache for the WebSocket consumers and their middleware.
+
+cache.aget, cache.aset, ... would queue every socket of a process on the one
+shared sync thread (see rides.db_executor); these run the same calls on the
+bounded pool instead.
+"""
+from django.core.cache import cache
+
+from rides.db_executor import pool_sync_to_async
+
+
+@pool_sync_to_async
+def aget(key, default=None):
+    return cache.get(key, default)
+
+
+@pool_sync_to_async
+def aget_many(keys):
+    return cache.get_many(keys)
+
+
+@pool_sync_to_async
+def aset(key, value, timeout):
+    cache.set(key, value, timeout=timeout)
+
+
+@pool_sync_to_async
+def aadd(key, value, timeout):
+    return cache.add(key, value, timeout=timeout)
@@ -1,10 +1,13 @@
 from django.urls import path
 
-from rides.consumers import RideChatConsumer, RideLocationConsumer
+from rides.consumers import (RideChatConsumer, RideLocationConsumer,
+                             RideStreamConsumer)
 
 # Define your WebSocket URL patterns here
 websocket_urlpatterns = [
     path("ws/rides/<int:ride_id>/location/", RideLocationConsumer.as_asgi()),
     path("ws/ride-chat/<int:ride_id>/<int:partner_id>/",RideChatConsumer.as_asgi()),
+    # One multiplexed socket per rider for location and every chat of the ride
+    path("ws/rides/<int:ride_id>/stream/", RideStreamConsumer.as_asgi()),
 
 ]
@@ -15,7 +15,7 @@ from datetime import timedelta
 from pathlib import Path
 
 import dj_database_url
-from decouple import config
+from decouple import Csv, config
 from django.contrib.gis.gdal import GDAL_VERSION
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -88,15 +88,95 @@ WSGI_APPLICATION = "voy.wsgi.application"
 ASGI_APPLICATION = "voy.asgi.application"
 
 
+# Redis instances the channel layer shards rides across (comma-separated URLs)
+CHANNEL_LAYER_HOSTS = config(
+    "CHANNEL_LAYER_HOSTS", default="redis://localhost:6379", cast=Csv()
+)
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "rides.channel_layers.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [("localhost", 6379)],
+            "hosts": CHANNEL_LAYER_HOSTS,
         },
     },
 }
 
+# Seconds a WebSocket handshake reuses the user resolved for a token (keyed by jti)
+RIDE_WS_PRINCIPAL_TTL = config("RIDE_WS_PRINCIPAL_TTL", default=60, cast=int)
+# Threads (one database connection each) running WebSocket database and cache work; 0 uses the shared sync thread
+RIDE_WS_DB_THREADS = config("RIDE_WS_DB_THREADS", default=8, cast=int)
+# Seconds a WebSocket database thread keeps its connection open
+RIDE_WS_DB_CONN_MAX_AGE = config("RIDE_WS_DB_CONN_MAX_AGE", default=60, cast=int)
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": config("REDIS_CACHE_URL", default="redis://localhost:6379/1"),
+    },
+}
+
+
+# Ride location streaming
+
+# Each connection publishes at most one location per this many seconds (latest wins)
+RIDE_LOCATION_MIN_INTERVAL = config("RIDE_LOCATION_MIN_INTERVAL", default=1.0, cast=float)
+# Positions closer than this many metres to the last published one are dropped
+RIDE_LOCATION_MIN_DISPLACEMENT = config("RIDE_LOCATION_MIN_DISPLACEMENT", default=5.0, cast=float)
+# ... unless nothing was published for this many seconds, so a parked rider's last position doesn't expire
+RIDE_LOCATION_MAX_SILENCE = config("RIDE_LOCATION_MAX_SILENCE", default=60.0, cast=float)
+# Ordered frames (chat, control) a WebSocket may have queued before it is closed as too slow
+RIDE_WS_MAX_QUEUED_FRAMES = config("RIDE_WS_MAX_QUEUED_FRAMES", default=256, cast=int)
+# Bytes of queued frames of any kind a WebSocket may have waiting before it is closed as too slow
+RIDE_WS_MAX_QUEUED_BYTES = config("RIDE_WS_MAX_QUEUED_BYTES", default=262144, cast=int)
+# Chat messages are written in batches of up to this many ...
+RIDE_CHAT_FLUSH_SIZE = config("RIDE_CHAT_FLUSH_SIZE", default=50, cast=int)
+# ... at most this many seconds after they were sent
+RIDE_CHAT_FLUSH_INTERVAL = config("RIDE_CHAT_FLUSH_INTERVAL", default=0.25, cast=float)
+# Queued chat messages kept while the database is failing; the oldest are dropped beyond it
+RIDE_CHAT_MAX_QUEUED = config("RIDE_CHAT_MAX_QUEUED", default=20000, cast=int)
+# Seconds a client-supplied chat message_id is remembered to drop re-sends
+RIDE_CHAT_DEDUP_TTL = config("RIDE_CHAT_DEDUP_TTL", default=86400, cast=int)
+# Seconds the last published position of a rider is kept for clients joining late
+RIDE_LOCATION_LAST_TTL = config("RIDE_LOCATION_LAST_TTL", default=300, cast=int)
+# Published positions are persisted in batches of this many points ...
+RIDE_TRAIL_BATCH_SIZE = config("RIDE_TRAIL_BATCH_SIZE", default=500, cast=int)
+# ... or at least every this many seconds
+RIDE_TRAIL_FLUSH_INTERVAL = config("RIDE_TRAIL_FLUSH_INTERVAL", default=5.0, cast=float)
+# Buffered trail points kept while the database is failing; the oldest are dropped beyond it
+RIDE_TRAIL_MAX_BUFFERED = config("RIDE_TRAIL_MAX_BUFFERED", default=100000, cast=int)
+# Douglas-Peucker tolerance in metres applied before a trail is written
+RIDE_TRAIL_TOLERANCE = config("RIDE_TRAIL_TOLERANCE", default=3.0, cast=float)
+
+
+# Ride search
+
+# Answer FindRidesView from an in-process grid index instead of PostGIS
+RIDE_SEARCH_INDEX_ENABLED = config("RIDE_SEARCH_INDEX_ENABLED", default=False, cast=bool)
+# Grid cell size in degrees (~1.1 km at the equator)
+RIDE_SEARCH_INDEX_CELL_DEGREES = config("RIDE_SEARCH_INDEX_CELL_DEGREES", default=0.01, cast=float)
+# Reload the index at least this often (seconds) to drop rides that have started
+RIDE_SEARCH_INDEX_MAX_AGE = config("RIDE_SEARCH_INDEX_MAX_AGE", default=300, cast=int)
+
+# Cache search candidates keyed on snapped pickup/destination cells
+RIDE_SEARCH_CACHE_ENABLED = config("RIDE_SEARCH_CACHE_ENABLED", default=False, cast=bool)
+# Snapping grid for cache keys in degrees (~220 m at the equator)
+RIDE_SEARCH_CACHE_CELL_DEGREES = config("RIDE_SEARCH_CACHE_CELL_DEGREES", default=0.002, cast=float)
+# Invalidation region size in degrees; a ride write bumps the regions of its endpoints
+RIDE_SEARCH_CACHE_REGION_DEGREES = config("RIDE_SEARCH_CACHE_REGION_DEGREES", default=0.05, cast=float)
+# Search radius is rounded up to a multiple of this many metres
+RIDE_SEARCH_CACHE_RADIUS_STEP = config("RIDE_SEARCH_CACHE_RADIUS_STEP", default=500, cast=int)
+# Seconds a cached candidate list lives
+RIDE_SEARCH_CACHE_TTL = config("RIDE_SEARCH_CACHE_TTL", default=30, cast=int)
+# Searches overlapping more invalidation regions than this (pickup plus destination) bypass the cache
+RIDE_SEARCH_CACHE_MAX_REGIONS = config("RIDE_SEARCH_CACHE_MAX_REGIONS", default=1000, cast=int)
+
+# Seconds a denormalized ride snapshot (RideStatusDetailsView) lives without being rebuilt
+RIDE_SNAPSHOT_TTL = config("RIDE_SNAPSHOT_TTL", default=600, cast=int)
+
+# Seconds a cached WebSocket access decision lives; status changes invalidate it sooner
+RIDE_ACCESS_CACHE_TTL = config("RIDE_ACCESS_CACHE_TTL", default=300, cast=int)
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases